@@ -16,10 +16,14 @@ from dotenv import load_dotenv
 
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
-from agent import FlowGladMigrationAgent, AgentConfig
-
 load_dotenv()
 
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 app = typer.Typer()
 console = Console()
 
@@ -38,6 +42,12 @@ def validate_environment():
     
     return True
 
+async def _run_agent(agent):
+    try:
+        return await agent.run()
+    finally:
+        await agent.close()
+
 @app.command()
 def migrate(
     repo: str = typer.Argument(..., help="GitHub repository (owner/name)"),
@@ -68,6 +78,8 @@ def migrate(
         else:
             raise typer.Exit(0)
     
+    from agent import FlowGladMigrationAgent, AgentConfig
+    
     config = AgentConfig(
         github_token=os.getenv("GITHUB_TOKEN"),
         repo_name=repo,
@@ -80,7 +92,7 @@ def migrate(
     agent = FlowGladMigrationAgent(config)
     
     try:
-        report = asyncio.run(agent.run())
+        report = asyncio.run(_run_agent(agent))
         
         if report.pr_url:
             console.print(f"\n[green]✓ Migration complete![/green]")
@@ -93,8 +105,6 @@ def migrate(
     except Exception as e:
         console.print(f"[red]Migration failed: {str(e)}[/red]")
         raise typer.Exit(1)
-    finally:
-        asyncio.run(agent.close())
 
 @app.command()
 def analyze(
@@ -107,6 +117,8 @@ def analyze(
     if not validate_environment():
         raise typer.Exit(1)
     
+    from agent import FlowGladMigrationAgent, AgentConfig
+    
     config = AgentConfig(
         github_token=os.getenv("GITHUB_TOKEN"),
         repo_name=repo,
@@ -117,7 +129,7 @@ def analyze(
     agent = FlowGladMigrationAgent(config)
     
     try:
-        report = asyncio.run(agent.run())
+        report = asyncio.run(_run_agent(agent))
         
         console.print(f"\n[cyan]Analysis Summary:[/cyan]")
         console.print(f"• Files with payment logic: {report.files_analyzed}")
@@ -128,8 +140,6 @@ def analyze(
     except Exception as e:
         console.print(f"[red]Analysis failed: {str(e)}[/red]")
         raise typer.Exit(1)
-    finally:
-        asyncio.run(agent.close())
 
 @app.command()
 def setup():
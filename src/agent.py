@@ -1,11 +1,12 @@
 import asyncio
 import os
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Awaitable, Callable, Hashable
 from dataclasses import dataclass
 from enum import Enum
 import json
+import httpx
 from rich.console import Console
-from rich.progress import Progress, SpinnerColumn, TextColumn
+from rich.progress import Progress, SpinnerColumn, TaskID, TextColumn
 from rich.table import Table
 from rich.panel import Panel
 
@@ -17,6 +18,15 @@ from morph_editor import MorphLLMEditor, EditRequest
 
 console = Console()
 
+MAX_CONCURRENT_FETCHES = 10
+MAX_CONCURRENT_LLM_CALLS = 4
+MAPPING_BATCH_SIZE = 6
+MAX_CONCURRENT_EDITS = 8
+HTTP_TIMEOUT = 60
+HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20)
+
+_REPORT_COLUMNS = (("Metric", "cyan", True), ("Value", "green", False))
+
 class AgentStatus(Enum):
     IDLE = "idle"
     AUTHENTICATING = "authenticating"
@@ -50,17 +60,20 @@ class FlowGladMigrationAgent:
     def __init__(self, config: AgentConfig):
         self.config = config
         self.status = AgentStatus.IDLE
+        self._http = httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
         self.mcp_connector = GitHubMCPConnector(
             MCPConfig(
                 server_url=os.getenv("MCP_SERVER_URL", "http://localhost:3000"),
                 github_token=config.github_token
-            )
+            ),
+            client=self._http
         )
         self.analyzer = PaymentLogicAnalyzer()
         self.mapper = PaymentFlowMapper(llm_provider=config.llm_provider)
         self.converter = FlowGladConverter()
-        self.editor = MorphLLMEditor()
+        self.editor = MorphLLMEditor(client=self._http)
         self.report = None
+        self._fetches: Dict[Hashable, asyncio.Future] = {}
     
     async def run(self) -> MigrationReport:
         try:
@@ -87,14 +100,18 @@ class FlowGladMigrationAgent:
                 progress.update(analyze_task, completed=1)
                 
                 map_task = progress.add_task("[cyan]Mapping payment flows...", total=1)
-                self.status = AgentStatus.MAPPING
-                flow_maps = await self._map_flows(payment_flows)
-                progress.update(map_task, completed=1)
-                
                 convert_task = progress.add_task("[cyan]Converting to FlowGlad...", total=1)
-                self.status = AgentStatus.CONVERTING
-                transformations = await self._convert_code(payment_flows)
-                progress.update(convert_task, completed=1)
+                self.status = AgentStatus.MAPPING
+                try:
+                    async with asyncio.TaskGroup() as tg:
+                        map_job = tg.create_task(self._map_flows(payment_flows))
+                        convert_job = tg.create_task(self._convert_code(payment_flows))
+                        map_job.add_done_callback(lambda _: self._mapping_done(progress, map_task, convert_job))
+                        convert_job.add_done_callback(lambda _: progress.update(convert_task, completed=1))
+                except* Exception as group:
+                    raise group.exceptions[0] from None
+                flow_maps = map_job.result()
+                transformations = convert_job.result()
                 
                 if self.config.auto_apply:
                     apply_task = progress.add_task("[cyan]Applying changes...", total=1)
@@ -115,6 +132,11 @@ class FlowGladMigrationAgent:
             console.print(f"[red]Error: {str(e)}[/red]")
             raise
     
+    def _mapping_done(self, progress: Progress, map_task: TaskID, convert_job: asyncio.Task):
+        progress.update(map_task, completed=1)
+        if not convert_job.done():
+            self.status = AgentStatus.CONVERTING
+    
     async def _authenticate(self):
         success = await self.mcp_connector.authenticate()
         if not success:
@@ -123,83 +145,172 @@ class FlowGladMigrationAgent:
         await self.mcp_connector.connect_to_mcp()
         console.print("[green]✓[/green] Authenticated with GitHub")
     
-    async def _analyze_repository(self) -> List[PaymentFlow]:
-        repo = await self.mcp_connector.get_repository(self.config.repo_name)
-        payment_files = await self.mcp_connector.search_payment_files(repo)
+    async def _fetch_once(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._fetches.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fetch())
+            self._fetches[key] = future
         
-        console.print(f"Found {len(payment_files)} potential payment files")
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            if self._fetches.get(key) is future:
+                del self._fetches[key]
+            raise
+    
+    async def _get_repo(self):
+        return await self._fetch_once(
+            ("repo",),
+            lambda: self.mcp_connector.get_repository(self.config.repo_name)
+        )
+
+    async def _get_content(self, repo, path: str) -> str:
+        return await self._fetch_once(
+            ("content", path),
+            lambda: self.mcp_connector.get_file_content(repo, path)
+        )
+
+    async def _isolate(self, job: Awaitable[Any], failure: str) -> Optional[Any]:
+        try:
+            return await job
+        except Exception as e:
+            console.print(f"[yellow]Warning: {failure}: {e}[/yellow]")
+            return None
+
+    async def _analyze_repository(self) -> List[PaymentFlow]:
+        repo = await self._get_repo()
+        fetch_limit = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
         
+        tasks = []
+        try:
+            async with asyncio.TaskGroup() as tg:
+                async for file_info in self.mcp_connector.iter_payment_files(repo):
+                    tasks.append(tg.create_task(self._isolate(
+                        self._fetch_and_analyze(repo, file_info, fetch_limit),
+                        f"Could not analyze {file_info['path']}"
+                    )))
+                
+                console.print(f"Found {len(tasks)} potential payment files")
+        except* Exception as group:
+            raise group.exceptions[0] from None
+
         all_flows = []
-        for file_info in payment_files:
-            try:
-                content = await self.mcp_connector.get_file_content(repo, file_info['path'])
-                flows = self.analyzer.analyze_file(file_info['path'], content)
-                all_flows.extend(flows)
-            except Exception as e:
-                console.print(f"[yellow]Warning: Could not analyze {file_info['path']}: {e}[/yellow]")
-        
+        for task in tasks:
+            if task.result() is not None:
+                all_flows.extend(task.result())
+
         console.print(f"[green]✓[/green] Identified {len(all_flows)} payment flows")
         return all_flows
+
+    async def _fetch_and_analyze(self, repo, file_info: Dict[str, Any],
+                                 fetch_limit: asyncio.Semaphore) -> List[PaymentFlow]:
+        async with fetch_limit:
+            content = await self._get_content(repo, file_info['path'])
+        return self.analyzer.analyze_file(file_info['path'], content)
     
     async def _map_flows(self, payment_flows: List[PaymentFlow]) -> List[Dict[str, Any]]:
+        repo = await self._get_repo()
+        llm_limit = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+
+        batches = [
+            payment_flows[i:i + MAPPING_BATCH_SIZE]
+            for i in range(0, len(payment_flows), MAPPING_BATCH_SIZE)
+        ]
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                tg.create_task(self._isolate(
+                    self._map_batch(repo, batch, llm_limit),
+                    f"Could not map flows in {', '.join(flow.file_path for flow in batch)}"
+                ))
+                for batch in batches
+            ]
+
         flow_maps = []
-        
-        for flow in payment_flows:
-            try:
-                repo = await self.mcp_connector.get_repository(self.config.repo_name)
-                content = await self.mcp_connector.get_file_content(repo, flow.file_path)
-                
-                flow_map = self.mapper.map_payment_flow(
-                    content,
-                    flow.provider.value,
-                    flow.flow_type
-                )
-                
-                comparison = self.mapper.compare_with_flowglad(flow_map)
-                flow_maps.append({
-                    "flow": flow,
-                    "map": flow_map,
-                    "comparison": comparison
-                })
-                
-            except Exception as e:
-                console.print(f"[yellow]Warning: Could not map flow in {flow.file_path}: {e}[/yellow]")
-        
+        for task in tasks:
+            if task.result() is not None:
+                flow_maps.extend(task.result())
+
         console.print(f"[green]✓[/green] Mapped {len(flow_maps)} payment flows")
         return flow_maps
-    
-    async def _convert_code(self, payment_flows: List[PaymentFlow]) -> List[CodeTransformation]:
-        transformations = []
-        files_processed = set()
-        
-        for flow in payment_flows:
-            if flow.file_path in files_processed:
-                continue
-            
-            files_processed.add(flow.file_path)
-            
+
+    async def _map_batch(self, repo, batch: List[PaymentFlow],
+                         llm_limit: asyncio.Semaphore) -> List[Dict[str, Any]]:
+        contents = await asyncio.gather(*(
+            self._isolate(self._get_content(repo, flow.file_path), f"Could not fetch {flow.file_path}")
+            for flow in batch
+        ))
+        flows = [flow for flow, content in zip(batch, contents) if content is not None]
+        items = [
+            (content, flow.provider.value, flow.flow_type)
+            for flow, content in zip(batch, contents)
+            if content is not None
+        ]
+        if not items:
+            return []
+
+        async with llm_limit:
             try:
-                repo = await self.mcp_connector.get_repository(self.config.repo_name)
-                content = await self.mcp_connector.get_file_content(repo, flow.file_path)
-                
-                file_type = self._get_file_type(flow.file_path)
-                transformation = self.converter.convert_code(
-                    content,
-                    flow.provider.value,
-                    file_type
+                maps = await asyncio.to_thread(
+                    self.mapper.map_payment_flows_batch,
+                    items,
+                    self.config.repo_name
                 )
-                
-                transformation.file_path = flow.file_path
-                transformations.append(transformation)
-                
-            except Exception as e:
-                console.print(f"[yellow]Warning: Could not convert {flow.file_path}: {e}[/yellow]")
-        
+            except Exception:
+                maps = [
+                    await self._isolate(
+                        asyncio.to_thread(self.mapper.map_payment_flow, *item, self.config.repo_name),
+                        f"Could not map {flow.file_path}"
+                    )
+                    for flow, item in zip(flows, items)
+                ]
+
+        return [
+            {
+                "flow": flow,
+                "map": flow_map,
+                "comparison": self.mapper.compare_with_flowglad(flow_map)
+            }
+            for flow, flow_map in zip(flows, maps)
+            if flow_map is not None
+        ]
+
+    async def _convert_code(self, payment_flows: List[PaymentFlow]) -> List[CodeTransformation]:
+        repo = await self._get_repo()
+
+        unique = {}
+        for flow in payment_flows:
+            unique.setdefault(flow.file_path, flow)
+        unique_flows = list(unique.values())
+
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                tg.create_task(self._isolate(
+                    self._convert_one(repo, flow),
+                    f"Could not convert {flow.file_path}"
+                ))
+                for flow in unique_flows
+            ]
+
+        transformations = [task.result() for task in tasks if task.result() is not None]
+
         console.print(f"[green]✓[/green] Generated {len(transformations)} code transformations")
         return transformations
-    
+
+    async def _convert_one(self, repo, flow: PaymentFlow) -> CodeTransformation:
+        content = await self._get_content(repo, flow.file_path)
+
+        file_type = self._get_file_type(flow.file_path)
+        transformation = self.converter.convert_code(
+            content,
+            flow.provider.value,
+            file_type
+        )
+
+        transformation.file_path = flow.file_path
+        return transformation
+
     async def _apply_changes(self, transformations: List[CodeTransformation]) -> Optional[str]:
-        repo = await self.mcp_connector.get_repository(self.config.repo_name)
+        repo = await self._get_repo()
         
         branch_name = await self.mcp_connector.create_branch(
             repo,
@@ -228,7 +339,8 @@ class FlowGladMigrationAgent:
                     "description": "Convert to FlowGlad"
                 }
                 for t in transformations
-            ]
+            ],
+            max_concurrency=MAX_CONCURRENT_EDITS
         )
         
         console.print(f"Applied {results['successful']} transformations")
@@ -280,21 +392,31 @@ class FlowGladMigrationAgent:
         )
     
     def _display_report(self, report: MigrationReport):
-        table = Table(title="Migration Report", show_header=True, header_style="bold magenta")
-        table.add_column("Metric", style="cyan", no_wrap=True)
-        table.add_column("Value", style="green")
-        
-        table.add_row("Repository", report.repo_name)
-        table.add_row("Files Analyzed", str(report.files_analyzed))
-        table.add_row("Payment Flows Found", str(report.payment_flows_found))
-        table.add_row("Files Converted", str(report.files_converted))
-        table.add_row("Success Rate", f"{report.conversion_success_rate:.1%}")
+        rows = [
+            ("Repository", report.repo_name),
+            ("Files Analyzed", str(report.files_analyzed)),
+            ("Payment Flows Found", str(report.payment_flows_found)),
+            ("Files Converted", str(report.files_converted)),
+            ("Success Rate", f"{report.conversion_success_rate:.1%}")
+        ]
         
         if report.pr_url:
-            table.add_row("Pull Request", report.pr_url)
+            rows.append(("Pull Request", report.pr_url))
+        
+        if not console.is_terminal:
+            print("\n".join(f"{metric}\t{value}" for metric, value in rows), file=console.file)
+            return
+        
+        table = Table(title="Migration Report", show_header=True, header_style="bold magenta")
+        for name, style, no_wrap in _REPORT_COLUMNS:
+            table.add_column(name, style=style, no_wrap=no_wrap)
+        
+        for row in rows:
+            table.add_row(*row)
         
         console.print(table)
     
     async def close(self):
         await self.mcp_connector.close()
-        await self.editor.client.aclose()
\ No newline at end of file
+        await self.editor.close()
+        await self._http.aclose()
\ No newline at end of file
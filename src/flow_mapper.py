@@ -1,12 +1,31 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from dataclasses import dataclass
+from collections import Counter, OrderedDict
+import hashlib
 import json
-import google.generativeai as genai
+import math
+import re
+import threading
+import time
 import os
 from dotenv import load_dotenv
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 load_dotenv()
 
+genai = None
+
+def _load_genai():
+    global genai
+    if genai is None:
+        import google.generativeai
+        genai = google.generativeai
+    return genai
+
 @dataclass
 class PaymentFlowMap:
     original_provider: str
@@ -18,17 +37,161 @@ class PaymentFlowMap:
     validation_rules: List[str]
     error_handling: List[str]
 
+RESPONSE_CACHE_SIZE = 2048
+
+_FLOWGLAD_MAPPING = {
+    "stripe": (
+        ("customer_creation", "flowglad.customers.create"),
+        ("payment_intent", "flowglad.checkout.create"),
+        ("subscription", "flowglad.subscriptions.create"),
+        ("webhook", "flowglad.webhooks.handle"),
+        ("refund", "flowglad.refunds.create")
+    ),
+    "square": (
+        ("payment_creation", "flowglad.payments.create"),
+        ("customer_creation", "flowglad.customers.create"),
+        ("subscription", "flowglad.subscriptions.create"),
+        ("checkout", "flowglad.checkout.create"),
+        ("refund", "flowglad.refunds.create")
+    )
+}
+
+_CLOSED_JSON_FENCE_RE = re.compile(r"```json\s*(\{.*?\}|\[.*?\])\s*```", re.DOTALL)
+_JSON_FENCE_RE = re.compile(r"```json\s*(\{.*?\}|\[.*?\])\s*(?:```|\Z)", re.DOTALL)
+_PLAIN_FENCE_RE = re.compile(r"```\s*(\{.*?\}|\[.*?\])\s*(?:```|\Z)", re.DOTALL)
+_TOKEN_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+|[^\sA-Za-z0-9_]")
+
+def _find_json_block(text: str) -> Optional[re.Match]:
+    if "```json" in text:
+        return _JSON_FENCE_RE.search(text)
+    return _PLAIN_FENCE_RE.search(text)
+
+class SemanticCache:
+    def __init__(self, threshold: float = 0.92, ttl: float = 3600.0, max_entries: int = 256):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: Dict[Tuple[str, str, str], List[Tuple[Dict[str, float], float, str]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def embed(code: str) -> Dict[str, float]:
+        counts = Counter(_TOKEN_RE.findall(code))
+        norm = math.sqrt(sum(c * c for c in counts.values()))
+        if not norm:
+            return {}
+        return {token: c / norm for token, c in counts.items()}
+
+    @staticmethod
+    def similarity(a: Dict[str, float], b: Dict[str, float]) -> float:
+        if len(a) > len(b):
+            a, b = b, a
+        return sum(weight * b.get(token, 0.0) for token, weight in a.items())
+
+    def get(self, namespace: str, provider: str, flow_type: str, code: str) -> Optional[str]:
+        vector = self.embed(code)
+        if not vector:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries.get((namespace, provider, flow_type))
+            if not entries:
+                return None
+
+            entries[:] = [entry for entry in entries if entry[1] > now]
+            best_score, best_response = 0.0, None
+            for stored, _, response in entries:
+                score = self.similarity(vector, stored)
+                if score > best_score:
+                    best_score, best_response = score, response
+
+        return best_response if best_score >= self.threshold else None
+
+    def put(self, namespace: str, provider: str, flow_type: str, code: str, response: str):
+        vector = self.embed(code)
+        if not vector:
+            return
+
+        with self._lock:
+            entries = self._entries.setdefault((namespace, provider, flow_type), [])
+            entries.append((vector, time.monotonic() + self.ttl, response))
+            if len(entries) > self.max_entries:
+                del entries[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 class PaymentFlowMapper:
     def __init__(self, llm_provider: str = "gemini"):
         self.llm_provider = llm_provider
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-        model_name = os.getenv("GEMINI_MODEL", "gemini-2.5-flash-lite")
-        self.client = genai.GenerativeModel(model_name)
+        sdk = _load_genai()
+        sdk.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        self.model_name = os.getenv("GEMINI_MODEL", "gemini-2.5-flash-lite")
+        self.client = sdk.GenerativeModel(self.model_name)
+        self.semantic_cache = SemanticCache()
+        self._response_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self._response_cache_lock = threading.Lock()
     
-    def map_payment_flow(self, code_content: str, provider: str, flow_type: str) -> PaymentFlowMap:
+    def map_payment_flow(self, code_content: str, provider: str, flow_type: str,
+                         namespace: str = "") -> PaymentFlowMap:
+        response = self.semantic_cache.get(namespace, provider, flow_type, code_content)
+        if response is None:
+            return self._map_single_flow(code_content, provider, flow_type, namespace)
+        return self._parse_flow_response(response, provider)
+
+    def map_payment_flows_batch(self, items: List[Tuple[str, str, str]],
+                                namespace: str = "") -> List[PaymentFlowMap]:
+        if len(items) == 1:
+            code_content, provider, flow_type = items[0]
+            return [self.map_payment_flow(code_content, provider, flow_type, namespace)]
+        
+        flow_maps: List[Optional[PaymentFlowMap]] = []
+        pending = []
+        for i, (code_content, provider, flow_type) in enumerate(items):
+            response = self.semantic_cache.get(namespace, provider, flow_type, code_content)
+            if response is None:
+                pending.append(i)
+                flow_maps.append(None)
+            else:
+                flow_maps.append(self._parse_flow_response(response, provider))
+        
+        if pending:
+            prompt = self._create_batch_mapping_prompt([items[i] for i in pending])
+            response = self._get_llm_response(prompt)
+            results = self._parse_batch_response(response, len(pending))
+            
+            if results is None:
+                for i in pending:
+                    code_content, provider, flow_type = items[i]
+                    flow_maps[i] = self._map_single_flow(code_content, provider, flow_type, namespace)
+            else:
+                self._store_llm_response(prompt, response)
+                for i, data in zip(pending, results):
+                    code_content, provider, flow_type = items[i]
+                    self.semantic_cache.put(namespace, provider, flow_type, code_content, json.dumps(data))
+                    flow_maps[i] = self._flow_map_from_data(data, provider)
+        
+        return flow_maps
+    
+    def _map_single_flow(self, code_content: str, provider: str, flow_type: str,
+                         namespace: str) -> PaymentFlowMap:
         prompt = self._create_mapping_prompt(code_content, provider, flow_type)
         response = self._get_llm_response(prompt)
-        return self._parse_flow_response(response, provider)
+        try:
+            data = self._parse_flow_data(response)
+        except Exception as e:
+            return self._error_flow_map(provider, e)
+        
+        self._store_llm_response(prompt, response)
+        self.semantic_cache.put(namespace, provider, flow_type, code_content, response)
+        return self._flow_map_from_data(data, provider)
+
+    def clear_cache(self):
+        self.semantic_cache.clear()
+        with self._response_cache_lock:
+            self._response_cache.clear()
     
     def _create_mapping_prompt(self, code: str, provider: str, flow_type: str) -> str:
         return f"""Analyze this {provider} {flow_type} payment implementation and extract:
@@ -55,45 +218,122 @@ Provide a structured analysis in JSON format with these fields:
 
 Focus on understanding the payment flow logic, not just the code structure."""
     
+    def _create_batch_mapping_prompt(self, items: List[Tuple[str, str, str]]) -> str:
+        sections = "\n\n".join(
+            f"""### Flow {i}
+Provider: {provider}
+Flow type: {flow_type}
+
+```
+{code}
+```"""
+            for i, (code, provider, flow_type) in enumerate(items, 1)
+        )
+        
+        return f"""Analyze each of the following {len(items)} payment implementations and extract for each one:
+
+1. Business flow steps (in order)
+2. Data entities involved
+3. API calls made
+4. Business logic rules
+5. Validation checks
+6. Error handling
+
+{sections}
+
+Respond with a JSON array containing exactly {len(items)} objects, one per flow and in the same order.
+Each object must have these fields:
+- flow_description: Short summary of the flow
+- steps: Array of flow steps with description and code references
+- entities: Array of data entities (customer, payment, subscription, etc.)
+- api_calls: Array of API endpoints/methods called
+- business_logic: Summary of core business rules
+- validation_rules: Array of validation checks
+- error_handling: Array of error scenarios handled
+
+Focus on understanding the payment flow logic, not just the code structure."""
+    
+    def _parse_batch_response(self, response: str, expected: int) -> Optional[List[Dict[str, Any]]]:
+        match = _find_json_block(response)
+        json_str = match.group(1) if match else response.strip()
+        try:
+            data = _json_loads(json_str)
+        except ValueError:
+            return None
+        
+        if not isinstance(data, list) or len(data) != expected:
+            return None
+        if not all(isinstance(item, dict) for item in data):
+            return None
+        return data
+    
+    def _response_key(self, prompt: str) -> Tuple[str, str]:
+        return (self.model_name, hashlib.sha256(prompt.encode()).hexdigest())
+    
     def _get_llm_response(self, prompt: str) -> str:
-        response = self.client.generate_content(prompt)
-        return response.text
+        key = self._response_key(prompt)
+        with self._response_cache_lock:
+            if key in self._response_cache:
+                self._response_cache.move_to_end(key)
+                return self._response_cache[key]
+
+        chunks = []
+        for chunk in self.client.generate_content(prompt, stream=True):
+            chunks.append(chunk.text)
+            if "`" in chunk.text and _CLOSED_JSON_FENCE_RE.search("".join(chunks)):
+                break
+        return "".join(chunks)
+    
+    def _store_llm_response(self, prompt: str, text: str):
+        key = self._response_key(prompt)
+        with self._response_cache_lock:
+            self._response_cache[key] = text
+            self._response_cache.move_to_end(key)
+            if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                self._response_cache.popitem(last=False)
     
     def _parse_flow_response(self, response: str, provider: str) -> PaymentFlowMap:
         try:
-            if "```json" in response:
-                json_str = response.split("```json")[1].split("```")[0]
-            elif "```" in response:
-                json_str = response.split("```")[1].split("```")[0]
-            else:
-                json_str = response
-            
-            data = json.loads(json_str.strip())
-            
-            return PaymentFlowMap(
-                original_provider=provider,
-                flow_description=data.get("flow_description", ""),
-                steps=data.get("steps", []),
-                entities=data.get("entities", []),
-                api_calls=data.get("api_calls", []),
-                business_logic=data.get("business_logic", ""),
-                validation_rules=data.get("validation_rules", []),
-                error_handling=data.get("error_handling", [])
-            )
+            data = self._parse_flow_data(response)
         except Exception as e:
-            return PaymentFlowMap(
-                original_provider=provider,
-                flow_description=f"Error parsing flow: {str(e)}",
-                steps=[],
-                entities=[],
-                api_calls=[],
-                business_logic="",
-                validation_rules=[],
-                error_handling=[]
-            )
+            return self._error_flow_map(provider, e)
+        return self._flow_map_from_data(data, provider)
+    
+    def _parse_flow_data(self, response: str) -> Dict[str, Any]:
+        match = _find_json_block(response)
+        json_str = match.group(1) if match else response.strip()
+        
+        data = _json_loads(json_str)
+        if not isinstance(data, dict):
+            raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+        return data
+    
+    def _flow_map_from_data(self, data: Dict[str, Any], provider: str) -> PaymentFlowMap:
+        return PaymentFlowMap(
+            original_provider=provider,
+            flow_description=data.get("flow_description", ""),
+            steps=data.get("steps", []),
+            entities=data.get("entities", []),
+            api_calls=data.get("api_calls", []),
+            business_logic=data.get("business_logic", ""),
+            validation_rules=data.get("validation_rules", []),
+            error_handling=data.get("error_handling", [])
+        )
+    
+    def _error_flow_map(self, provider: str, error: Exception) -> PaymentFlowMap:
+        return PaymentFlowMap(
+            original_provider=provider,
+            flow_description=f"Error parsing flow: {str(error)}",
+            steps=[],
+            entities=[],
+            api_calls=[],
+            business_logic="",
+            validation_rules=[],
+            error_handling=[]
+        )
     
     def generate_documentation(self, flow_map: PaymentFlowMap) -> str:
-        doc = f"""# Payment Flow Documentation
+        parts = [f"""# Payment Flow Documentation
 
 ## Original Provider: {flow_map.original_provider}
 
@@ -101,65 +341,46 @@ Focus on understanding the payment flow logic, not just the code structure."""
 {flow_map.flow_description}
 
 ## Process Steps
-"""
+"""]
         for i, step in enumerate(flow_map.steps, 1):
-            doc += f"{i}. {step.get('description', 'Step ' + str(i))}\n"
+            parts.append(f"{i}. {step.get('description', 'Step ' + str(i))}\n")
             if 'code_reference' in step:
-                doc += f"   - Code: {step['code_reference']}\n"
+                parts.append(f"   - Code: {step['code_reference']}\n")
         
-        doc += f"""
+        parts.append(f"""
 
 ## Data Entities
 {', '.join(flow_map.entities)}
 
 ## API Calls
-"""
-        for call in flow_map.api_calls:
-            doc += f"- {call}\n"
+""")
+        parts.extend(f"- {call}\n" for call in flow_map.api_calls)
         
-        doc += f"""
+        parts.append(f"""
 
 ## Business Logic
 {flow_map.business_logic}
 
 ## Validation Rules
-"""
-        for rule in flow_map.validation_rules:
-            doc += f"- {rule}\n"
+""")
+        parts.extend(f"- {rule}\n" for rule in flow_map.validation_rules)
         
-        doc += f"""
+        parts.append("""
 
 ## Error Handling
-"""
-        for error in flow_map.error_handling:
-            doc += f"- {error}\n"
+""")
+        parts.extend(f"- {error}\n" for error in flow_map.error_handling)
         
-        return doc
+        return "".join(parts)
     
     def compare_with_flowglad(self, flow_map: PaymentFlowMap) -> Dict[str, Any]:
-        flowglad_mapping = {
-            "stripe": {
-                "customer_creation": "flowglad.customers.create",
-                "payment_intent": "flowglad.checkout.create",
-                "subscription": "flowglad.subscriptions.create",
-                "webhook": "flowglad.webhooks.handle",
-                "refund": "flowglad.refunds.create"
-            },
-            "square": {
-                "payment_creation": "flowglad.payments.create",
-                "customer_creation": "flowglad.customers.create",
-                "subscription": "flowglad.subscriptions.create",
-                "checkout": "flowglad.checkout.create",
-                "refund": "flowglad.refunds.create"
-            }
-        }
-        
-        provider_lower = flow_map.original_provider.lower()
+        provider_map = _FLOWGLAD_MAPPING.get(flow_map.original_provider.lower(), ())
         equivalents = []
         
         for api_call in flow_map.api_calls:
-            for pattern, flowglad_method in flowglad_mapping.get(provider_lower, {}).items():
-                if pattern in api_call.lower():
+            api_lower = api_call.lower()
+            for pattern, flowglad_method in provider_map:
+                if pattern in api_lower:
                     equivalents.append({
                         "original": api_call,
                         "flowglad": flowglad_method
@@ -1,14 +1,221 @@
+import io
 import re
-from typing import Dict, List, Tuple, Optional
-from dataclasses import dataclass
+from typing import Dict, List, Tuple, Optional, TextIO
+from dataclasses import dataclass, field
 import ast
 
+_JS_RULES = {
+    "stripe": [
+        (r"const stripe = require\('stripe'\)", "const flowglad = require('flowglad')"),
+        (r"import Stripe from 'stripe'", "import FlowGlad from 'flowglad'"),
+        (r"new Stripe\((.*?)\)", r"new FlowGlad(\1)"),
+        (r"stripe\.customers\.create", "flowglad.customers.create"),
+        (r"stripe\.paymentIntents\.create", "flowglad.checkout.sessions.create"),
+        (r"stripe\.subscriptions\.create", "flowglad.subscriptions.create"),
+        (r"stripe\.prices\.create", "flowglad.prices.create"),
+        (r"stripe\.products\.create", "flowglad.products.create"),
+        (r"stripe\.webhooks\.constructEvent", "flowglad.webhooks.verify"),
+        (r"process\.env\.STRIPE_SECRET_KEY", "process.env.FLOWGLAD_SECRET_KEY"),
+    ],
+    "square": [
+        (r"const \{ Client \} = require\('square'\)", "const { FlowGlad } = require('flowglad')"),
+        (r"import \{ Client \} from 'square'", "import { FlowGlad } from 'flowglad'"),
+        (r"new Client\((.*?)\)", r"new FlowGlad(\1)"),
+        (r"\.paymentsApi\.createPayment", ".payments.create"),
+        (r"\.customersApi\.createCustomer", ".customers.create"),
+        (r"\.subscriptionsApi\.createSubscription", ".subscriptions.create"),
+        (r"process\.env\.SQUARE_ACCESS_TOKEN", "process.env.FLOWGLAD_SECRET_KEY"),
+    ]
+}
+
+_BACKREF_RE = re.compile(r"\\(\d+)")
+_ESCAPE_RE = re.compile(r"\\([^A-Za-z0-9])")
+_METACHARS = frozenset(".^$*+?{}[]|()\\")
+
+def _as_literal(pattern: str) -> Optional[str]:
+    literal = _ESCAPE_RE.sub("", pattern)
+    if any(c in _METACHARS for c in literal):
+        return None
+    return _ESCAPE_RE.sub(r"\1", pattern)
+
+class _RuleSet:
+    def __init__(self, rules: List[Tuple[re.Pattern, str]]):
+        self.literals: List[Tuple[str, str]] = []
+        self._templates: Dict[str, str] = {}
+        alternatives = []
+        group = 1
+        for pattern, replacement in rules:
+            literal = _as_literal(pattern.pattern)
+            if literal is not None and "\\" not in replacement:
+                self.literals.append((literal, replacement))
+                continue
+            
+            name = f"r{len(alternatives)}"
+            alternatives.append(f"(?P<{name}>{pattern.pattern})")
+            self._templates[name] = _BACKREF_RE.sub(
+                lambda ref: f"\\g<{group + int(ref.group(1))}>", replacement
+            )
+            group += 1 + pattern.groups
+        self.pattern = re.compile("|".join(alternatives)) if alternatives else None
+    
+    def apply(self, code: str) -> str:
+        for old, new in self.literals:
+            code = code.replace(old, new)
+        if self.pattern is not None:
+            code = self.pattern.sub(self._expand, code)
+        return code
+    
+    def _expand(self, match: re.Match) -> str:
+        return match.expand(self._templates[match.lastgroup])
+
+_JS_RULE_SETS = {
+    provider: _RuleSet([(re.compile(pattern), replacement) for pattern, replacement in rules])
+    for provider, rules in _JS_RULES.items()
+}
+
+_SENTINELS = {
+    "stripe": ("stripe", "STRIPE_"),
+    "square": ("square", "SQUARE_", "Client(", "_api.")
+}
+
+_JS_SENTINELS = {
+    "stripe": ("stripe", "Stripe", "STRIPE_"),
+    "square": ("square", "SQUARE_", "Client(", "Api.")
+}
+
+_PROVIDER_PROBE = re.compile(
+    r"(?P<stripe>\b[Ss]tripe\b|STRIPE_)"
+    r"|(?P<square>\bsquare\b|SQUARE_|\b(?:payments|customers|subscriptions|catalog|refunds)_?[Aa]pi\b)"
+)
+
+def detect_provider(code: str) -> Optional[str]:
+    match = _PROVIDER_PROBE.search(code)
+    return match.lastgroup if match else None
+
+_PARAM_MAPPINGS = {
+    "stripe": {
+        "amount": "amount",
+        "currency": "currency",
+        "customer": "customer_id",
+        "payment_method": "payment_method_id",
+        "description": "description",
+        "metadata": "metadata",
+        "automatic_payment_methods": "auto_confirm",
+        "payment_method_types": "payment_methods",
+        "line_items": "items",
+        "mode": "checkout_mode",
+        "success_url": "success_url",
+        "cancel_url": "cancel_url",
+        "price": "price_id",
+        "quantity": "quantity",
+    },
+    "square": {
+        "amount_money": "amount",
+        "source_id": "payment_source",
+        "idempotency_key": "idempotency_key",
+        "customer_id": "customer_id",
+        "location_id": "location_id",
+        "reference_id": "reference_id",
+        "note": "description",
+        "card_id": "payment_method_id",
+    }
+}
+
+_PARAM_RENAMES = {
+    provider: {old_param: new_param for old_param, new_param in mappings.items() if old_param != new_param}
+    for provider, mappings in _PARAM_MAPPINGS.items()
+}
+
+_PARAM_PATTERNS = {
+    provider: [
+        (f'{old_param}=', re.compile(rf'\b{old_param}='), f'{new_param}=')
+        for old_param, new_param in renames.items()
+    ]
+    for provider, renames in _PARAM_RENAMES.items()
+}
+
+_NEWLINE_RE = re.compile(r"\r\n?|\n")
+
+_IMPORT_LINE_RE = re.compile(r"^(?:import |from )", re.MULTILINE)
+_FLOWGLAD_IMPORTS = "import flowglad\nfrom dotenv import load_dotenv\nload_dotenv()\n\n"
+
+_MIGRATION_SCRIPT_HEADER = """#!/usr/bin/env python3
+\"\"\"
+FlowGlad Migration Script
+Automatically converts Stripe/Square code to FlowGlad
+\"\"\"
+
+import os
+import re
+import shutil
+from datetime import datetime
+
+def backup_files(files):
+    backup_dir = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    os.makedirs(backup_dir, exist_ok=True)
+    
+    for file in files:
+        shutil.copy2(file, os.path.join(backup_dir, os.path.basename(file)))
+    
+    return backup_dir
+
+def apply_transformations(transformations):
+    for transform in transformations:
+        with open(transform['file_path'], 'w') as f:
+            f.write(transform['transformed_code'])
+    
+    print(f"Applied {len(transformations)} transformations")
+
+ENV_UPDATES = {
+    'STRIPE_SECRET_KEY': 'FLOWGLAD_SECRET_KEY',
+    'STRIPE_PUBLISHABLE_KEY': 'FLOWGLAD_PUBLISHABLE_KEY',
+    'SQUARE_ACCESS_TOKEN': 'FLOWGLAD_SECRET_KEY',
+}
+ENV_PATTERN = re.compile('|'.join(map(re.escape, ENV_UPDATES)))
+
+def update_env_file():
+    if os.path.exists('.env'):
+        with open('.env', 'r') as f:
+            content = f.read()
+        
+        updated = ENV_PATTERN.sub(lambda match: ENV_UPDATES[match.group(0)], content)
+        
+        if updated != content:
+            with open('.env', 'w') as f:
+                f.write(updated)
+            
+            print("Updated .env file")
+
+def main():
+    transformations = [
+"""
+
+_MIGRATION_SCRIPT_FOOTER = """    ]
+    
+    files = [t['file_path'] for t in transformations]
+    backup_dir = backup_files(files)
+    print(f"Created backup in {backup_dir}")
+    
+    apply_transformations(transformations)
+    update_env_file()
+    
+    print("Migration complete!")
+    print("Run 'pip install flowglad' to install the FlowGlad SDK")
+
+if __name__ == "__main__":
+    main()
+"""
+
 @dataclass
 class ConversionRule:
     pattern: str
     replacement: str
     description: str
     provider: str
+    compiled: re.Pattern = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        self.compiled = re.compile(self.pattern)
 
 @dataclass
 class CodeTransformation:
@@ -21,6 +228,8 @@ class CodeTransformation:
 class FlowGladConverter:
     def __init__(self):
         self.conversion_rules = self._initialize_conversion_rules()
+        self._rules_by_provider = self._index_rules(self.conversion_rules)
+        self._rule_sets = self._build_rule_sets(self._rules_by_provider)
         
     def _initialize_conversion_rules(self) -> List[ConversionRule]:
         return [
@@ -163,7 +372,23 @@ class FlowGladConverter:
             ),
         ]
     
-    def convert_code(self, code: str, provider: str, file_type: str = "python") -> CodeTransformation:
+    def _index_rules(self, rules: List[ConversionRule]) -> Dict[str, List[ConversionRule]]:
+        by_provider: Dict[str, List[ConversionRule]] = {}
+        for rule in rules:
+            by_provider.setdefault(rule.provider, []).append(rule)
+        return by_provider
+    
+    def _build_rule_sets(self, rules_by_provider: Dict[str, List[ConversionRule]]) -> Dict[str, _RuleSet]:
+        return {
+            provider: _RuleSet([(rule.compiled, rule.replacement) for rule in provider_rules])
+            for provider, provider_rules in rules_by_provider.items()
+        }
+    
+    def convert_code(self, code: str, provider: Optional[str] = None, file_type: str = "python") -> CodeTransformation:
+        provider = provider or detect_provider(code)
+        if provider is None:
+            return self._noop_transformation(code)
+        
         if file_type == "python":
             return self._convert_python(code, provider)
         elif file_type in ["javascript", "typescript"]:
@@ -172,11 +397,11 @@ class FlowGladConverter:
             return self._convert_generic(code, provider)
     
     def _convert_python(self, code: str, provider: str) -> CodeTransformation:
-        transformed_code = code
-        provider_rules = [r for r in self.conversion_rules if r.provider == provider]
+        if not self._mentions_provider(code, _SENTINELS.get(provider, ())):
+            return self._noop_transformation(code)
         
-        for rule in provider_rules:
-            transformed_code = re.sub(rule.pattern, rule.replacement, transformed_code)
+        rule_set = self._rule_sets.get(provider)
+        transformed_code = rule_set.apply(code) if rule_set else code
         
         transformed_code = self._update_python_params(transformed_code, provider)
         transformed_code = self._add_flowglad_imports(transformed_code)
@@ -190,33 +415,11 @@ class FlowGladConverter:
         )
     
     def _convert_javascript(self, code: str, provider: str) -> CodeTransformation:
-        js_rules = {
-            "stripe": [
-                (r"const stripe = require\('stripe'\)", "const flowglad = require('flowglad')"),
-                (r"import Stripe from 'stripe'", "import FlowGlad from 'flowglad'"),
-                (r"new Stripe\((.*?)\)", r"new FlowGlad(\1)"),
-                (r"stripe\.customers\.create", "flowglad.customers.create"),
-                (r"stripe\.paymentIntents\.create", "flowglad.checkout.sessions.create"),
-                (r"stripe\.subscriptions\.create", "flowglad.subscriptions.create"),
-                (r"stripe\.prices\.create", "flowglad.prices.create"),
-                (r"stripe\.products\.create", "flowglad.products.create"),
-                (r"stripe\.webhooks\.constructEvent", "flowglad.webhooks.verify"),
-                (r"process\.env\.STRIPE_SECRET_KEY", "process.env.FLOWGLAD_SECRET_KEY"),
-            ],
-            "square": [
-                (r"const \{ Client \} = require\('square'\)", "const { FlowGlad } = require('flowglad')"),
-                (r"import \{ Client \} from 'square'", "import { FlowGlad } from 'flowglad'"),
-                (r"new Client\((.*?)\)", r"new FlowGlad(\1)"),
-                (r"\.paymentsApi\.createPayment", ".payments.create"),
-                (r"\.customersApi\.createCustomer", ".customers.create"),
-                (r"\.subscriptionsApi\.createSubscription", ".subscriptions.create"),
-                (r"process\.env\.SQUARE_ACCESS_TOKEN", "process.env.FLOWGLAD_SECRET_KEY"),
-            ]
-        }
+        if not self._mentions_provider(code, _JS_SENTINELS.get(provider, ())):
+            return self._noop_transformation(code)
         
-        transformed_code = code
-        for pattern, replacement in js_rules.get(provider, []):
-            transformed_code = re.sub(pattern, replacement, transformed_code)
+        rule_set = _JS_RULE_SETS.get(provider)
+        transformed_code = rule_set.apply(code) if rule_set else code
         
         return CodeTransformation(
             original_code=code,
@@ -227,11 +430,11 @@ class FlowGladConverter:
         )
     
     def _convert_generic(self, code: str, provider: str) -> CodeTransformation:
-        transformed_code = code
-        provider_rules = [r for r in self.conversion_rules if r.provider == provider]
+        if not self._mentions_provider(code, _SENTINELS.get(provider, ())):
+            return self._noop_transformation(code)
         
-        for rule in provider_rules:
-            transformed_code = re.sub(rule.pattern, rule.replacement, transformed_code)
+        rule_set = self._rule_sets.get(provider)
+        transformed_code = rule_set.apply(code) if rule_set else code
         
         return CodeTransformation(
             original_code=code,
@@ -241,137 +444,81 @@ class FlowGladConverter:
             transformation_type="generic_conversion"
         )
     
+    def _mentions_provider(self, code: str, sentinels: Tuple[str, ...]) -> bool:
+        return any(token in code for token in sentinels)
+    
+    def _noop_transformation(self, code: str) -> CodeTransformation:
+        return CodeTransformation(
+            original_code=code,
+            transformed_code=code,
+            file_path="",
+            line_range=(0, 0),
+            transformation_type="noop"
+        )
+    
     def _update_python_params(self, code: str, provider: str) -> str:
-        param_mappings = {
-            "stripe": {
-                "amount": "amount",
-                "currency": "currency",
-                "customer": "customer_id",
-                "payment_method": "payment_method_id",
-                "description": "description",
-                "metadata": "metadata",
-                "automatic_payment_methods": "auto_confirm",
-                "payment_method_types": "payment_methods",
-                "line_items": "items",
-                "mode": "checkout_mode",
-                "success_url": "success_url",
-                "cancel_url": "cancel_url",
-                "price": "price_id",
-                "quantity": "quantity",
-            },
-            "square": {
-                "amount_money": "amount",
-                "source_id": "payment_source",
-                "idempotency_key": "idempotency_key",
-                "customer_id": "customer_id",
-                "location_id": "location_id",
-                "reference_id": "reference_id",
-                "note": "description",
-                "card_id": "payment_method_id",
-            }
-        }
+        renames = _PARAM_RENAMES.get(provider, {})
+        if not any(old_param in code for old_param in renames):
+            return code
         
-        if provider in param_mappings:
-            for old_param, new_param in param_mappings[provider].items():
-                code = re.sub(
-                    rf'\b{old_param}=',
-                    f'{new_param}=',
-                    code
-                )
+        try:
+            tree = ast.parse(code)
+        except SyntaxError:
+            return self._update_params_textually(code, provider)
         
-        return code
-    
-    def _add_flowglad_imports(self, code: str) -> str:
-        lines = code.split('\n')
-        import_added = False
+        line_starts = [0] + [match.end() for match in _NEWLINE_RE.finditer(code)]
+        edits = []
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call):
+                continue
+            for keyword in node.keywords:
+                if keyword.arg not in renames:
+                    continue
+                line_start = line_starts[keyword.lineno - 1]
+                line_end = line_starts[keyword.lineno] if keyword.lineno < len(line_starts) else len(code)
+                column = len(code[line_start:line_end].encode()[:keyword.col_offset].decode())
+                edits.append((line_start + column, keyword.arg))
         
-        for i, line in enumerate(lines):
-            if 'import flowglad' in line or 'from flowglad' in line:
-                import_added = True
-                break
+        if not edits:
+            return code
         
-        if not import_added:
-            for i, line in enumerate(lines):
-                if line.startswith('import ') or line.startswith('from '):
-                    lines.insert(i, 'import flowglad')
-                    lines.insert(i+1, 'from dotenv import load_dotenv')
-                    lines.insert(i+2, 'load_dotenv()')
-                    lines.insert(i+3, '')
-                    break
-        
-        return '\n'.join(lines)
+        parts = []
+        position = 0
+        for offset, old_param in sorted(edits):
+            parts.append(code[position:offset])
+            parts.append(renames[old_param])
+            position = offset + len(old_param)
+        parts.append(code[position:])
+        return ''.join(parts)
     
-    def generate_migration_script(self, transformations: List[CodeTransformation]) -> str:
-        script = """#!/usr/bin/env python3
-\"\"\"
-FlowGlad Migration Script
-Automatically converts Stripe/Square code to FlowGlad
-\"\"\"
-
-import os
-import shutil
-from datetime import datetime
-
-def backup_files(files):
-    backup_dir = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    os.makedirs(backup_dir, exist_ok=True)
-    
-    for file in files:
-        shutil.copy2(file, os.path.join(backup_dir, os.path.basename(file)))
-    
-    return backup_dir
-
-def apply_transformations(transformations):
-    for transform in transformations:
-        with open(transform['file_path'], 'w') as f:
-            f.write(transform['transformed_code'])
-    
-    print(f"Applied {len(transformations)} transformations")
-
-def update_env_file():
-    env_updates = {
-        'STRIPE_SECRET_KEY': 'FLOWGLAD_SECRET_KEY',
-        'STRIPE_PUBLISHABLE_KEY': 'FLOWGLAD_PUBLISHABLE_KEY',
-        'SQUARE_ACCESS_TOKEN': 'FLOWGLAD_SECRET_KEY',
-    }
-    
-    if os.path.exists('.env'):
-        with open('.env', 'r') as f:
-            content = f.read()
+    def _update_params_textually(self, code: str, provider: str) -> str:
+        for keyword, pattern, replacement in _PARAM_PATTERNS.get(provider, []):
+            if keyword in code:
+                code = pattern.sub(replacement, code)
         
-        for old, new in env_updates.items():
-            content = content.replace(old, new)
+        return code
+    
+    def _add_flowglad_imports(self, code: str) -> str:
+        if 'import flowglad' in code or 'from flowglad' in code:
+            return code
         
-        with open('.env', 'w') as f:
-            f.write(content)
+        match = _IMPORT_LINE_RE.search(code)
+        if match is None:
+            return code
         
-        print("Updated .env file")
-
-def main():
-    transformations = [
-"""
+        return code[:match.start()] + _FLOWGLAD_IMPORTS + code[match.start():]
+    
+    def generate_migration_script(self, transformations: List[CodeTransformation],
+                                  out: Optional[TextIO] = None) -> Optional[str]:
+        buffer = out if out is not None else io.StringIO()
+        buffer.write(_MIGRATION_SCRIPT_HEADER)
         
         for t in transformations:
-            script += f"""        {{
-            'file_path': '{t.file_path}',
-            'transformed_code': '''{t.transformed_code}'''
+            buffer.write(f"""        {{
+            'file_path': {t.file_path!r},
+            'transformed_code': {t.transformed_code!r}
         }},
-"""
-        
-        script += """    ]
-    
-    files = [t['file_path'] for t in transformations]
-    backup_dir = backup_files(files)
-    print(f"Created backup in {backup_dir}")
-    
-    apply_transformations(transformations)
-    update_env_file()
-    
-    print("Migration complete!")
-    print("Run 'pip install flowglad' to install the FlowGlad SDK")
-
-if __name__ == "__main__":
-    main()
-"""
+""")
         
-        return script
\ No newline at end of file
+        buffer.write(_MIGRATION_SCRIPT_FOOTER)
+        return buffer.getvalue() if out is None else None
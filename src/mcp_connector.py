@@ -1,15 +1,39 @@
+from __future__ import annotations
+
 import os
 import json
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable, Awaitable, AsyncIterator, Hashable, TYPE_CHECKING
+from itertools import islice
 from dataclasses import dataclass
 import httpx
-from github import Github, Repository
 from dotenv import load_dotenv
 import asyncio
+import time
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 load_dotenv()
 
+if TYPE_CHECKING:
+    from github import Repository
+
+Github = None
+
+def _load_github():
+    global Github
+    if Github is None:
+        import github
+        Github = github.Github
+    return Github
+
+GITHUB_API_URL = "https://api.github.com"
+SEARCH_CACHE_TTL = 300
+SEARCH_BATCH_SIZE = 30
+
+PAYMENT_SEARCH_TERMS = " OR ".join([
+    "stripe", "square", "payment", "billing",
+    "checkout", "subscription", "charge", "customer"
+])
+
 @dataclass
 class MCPConfig:
     server_url: str
@@ -17,18 +41,21 @@ class MCPConfig:
     timeout: int = 30
 
 class GitHubMCPConnector:
-    def __init__(self, config: Optional[MCPConfig] = None):
+    def __init__(self, config: Optional[MCPConfig] = None, client: Optional[httpx.AsyncClient] = None):
         self.config = config or MCPConfig(
             server_url=os.getenv("MCP_SERVER_URL", "http://localhost:3000"),
             github_token=os.getenv("GITHUB_TOKEN", "")
         )
-        self.github = Github(self.config.github_token)
-        self.client = httpx.AsyncClient(timeout=self.config.timeout)
+        self.github = _load_github()(self.config.github_token)
+        self._owns_client = client is None
+        self.client = client or httpx.AsyncClient(timeout=self.config.timeout)
         self._authenticated = False
+        self._cache: Dict[Hashable, asyncio.Future] = {}
+        self._cache_expiry: Dict[Hashable, float] = {}
         
     async def authenticate(self) -> bool:
         try:
-            user = self.github.get_user()
+            user = await asyncio.to_thread(self.github.get_user)
             self._authenticated = True
             return True
         except Exception as e:
@@ -47,57 +74,138 @@ class GitHubMCPConnector:
         response.raise_for_status()
         return response.json()
     
+    async def _cached(self, key: Hashable, fetch: Callable[[], Awaitable[Any]],
+                      ttl: Optional[float] = None) -> Any:
+        expiry = self._cache_expiry.get(key)
+        if expiry is not None and expiry <= time.monotonic():
+            self._cache.pop(key, None)
+            self._cache_expiry.pop(key, None)
+        
+        future = self._cache.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fetch())
+            self._cache[key] = future
+            if ttl is not None:
+                self._cache_expiry[key] = time.monotonic() + ttl
+        
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            if self._cache.get(key) is future:
+                self._cache.pop(key, None)
+                self._cache_expiry.pop(key, None)
+            raise
+    
+    def clear_cache(self):
+        self._cache.clear()
+        self._cache_expiry.clear()
+    
     async def get_repository(self, repo_name: str) -> Repository:
-        return self.github.get_repo(repo_name)
+        return await self._cached(
+            ("repo", repo_name),
+            lambda: asyncio.to_thread(self.github.get_repo, repo_name)
+        )
     
     async def list_repository_files(self, repo: Repository, path: str = "") -> List[Dict[str, Any]]:
-        contents = repo.get_contents(path)
+        tree = await asyncio.to_thread(repo.get_git_tree, sha=repo.default_branch, recursive=True)
+        if tree.raw_data.get("truncated"):
+            return await self._walk_repository_files(repo, path)
+        
+        prefix = f"{path.strip('/')}/" if path.strip('/') else ""
+        return [
+            {
+                "path": element.path,
+                "name": element.path.rsplit('/', 1)[-1],
+                "size": element.size,
+                "sha": element.sha,
+                "type": "file"
+            }
+            for element in tree.tree
+            if element.type == "blob" and element.path.startswith(prefix)
+        ]
+    
+    async def _walk_repository_files(self, repo: Repository, path: str) -> List[Dict[str, Any]]:
         files = []
+        pending = [path.strip('/')]
         
-        while contents:
-            file_content = contents.pop(0)
-            if file_content.type == "dir":
-                contents.extend(repo.get_contents(file_content.path))
-            else:
-                files.append({
-                    "path": file_content.path,
-                    "name": file_content.name,
-                    "size": file_content.size,
-                    "sha": file_content.sha,
-                    "type": file_content.type
-                })
+        while pending:
+            listings = await asyncio.gather(*(self._list_directory(repo, p) for p in pending))
+            pending = []
+            for entries in listings:
+                for entry in entries:
+                    if entry["type"] == "dir":
+                        pending.append(entry["path"])
+                    else:
+                        files.append({
+                            "path": entry["path"],
+                            "name": entry["name"],
+                            "size": entry["size"],
+                            "sha": entry["sha"],
+                            "type": entry["type"]
+                        })
         
         return files
     
+    async def _list_directory(self, repo: Repository, path: str) -> List[Dict[str, Any]]:
+        response = await self.client.get(
+            f"{GITHUB_API_URL}/repos/{repo.full_name}/contents/{path}",
+            params={"ref": repo.default_branch},
+            headers={
+                "Authorization": f"Bearer {self.config.github_token}",
+                "Accept": "application/vnd.github+json"
+            }
+        )
+        response.raise_for_status()
+        entries = response.json()
+        return entries if isinstance(entries, list) else [entries]
+    
     async def get_file_content(self, repo: Repository, file_path: str) -> str:
-        file_content = repo.get_contents(file_path)
+        return await self._cached(
+            ("content", repo.full_name, file_path),
+            lambda: self._fetch_file_content(repo, file_path)
+        )
+    
+    async def _fetch_file_content(self, repo: Repository, file_path: str) -> str:
+        file_content = await asyncio.to_thread(repo.get_contents, file_path)
         if isinstance(file_content, list):
             file_content = file_content[0]
         return file_content.decoded_content.decode('utf-8')
     
     async def search_payment_files(self, repo: Repository) -> List[Dict[str, Any]]:
-        payment_patterns = [
-            "stripe", "square", "payment", "billing", 
-            "checkout", "subscription", "charge", "customer"
-        ]
-        
-        query = f"repo:{repo.full_name} " + " OR ".join(payment_patterns)
-        code_results = self.github.search_code(query=query)
-        
-        payment_files = []
-        for result in code_results:
-            payment_files.append({
-                "path": result.path,
-                "repository": result.repository.full_name,
-                "sha": result.sha,
-                "score": result.score
-            })
+        payment_files = await self._cached(
+            ("search", repo.full_name),
+            lambda: self._search_payment_files(repo),
+            ttl=SEARCH_CACHE_TTL
+        )
+        return list(payment_files)
+    
+    async def _search_payment_files(self, repo: Repository) -> List[Dict[str, Any]]:
+        return [file_info async for file_info in self.iter_payment_files(repo)]
+    
+    async def iter_payment_files(self, repo: Repository, limit: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        query = f"repo:{repo.full_name} {PAYMENT_SEARCH_TERMS}"
+        code_results = iter(await asyncio.to_thread(self.github.search_code, query=query))
+        remaining = limit
         
-        return payment_files
+        while remaining is None or remaining > 0:
+            batch_size = SEARCH_BATCH_SIZE if remaining is None else min(remaining, SEARCH_BATCH_SIZE)
+            batch = await asyncio.to_thread(lambda: list(islice(code_results, batch_size)))
+            for result in batch:
+                yield {
+                    "path": result.path,
+                    "repository": result.repository.full_name,
+                    "sha": result.sha,
+                    "score": result.score
+                }
+            if len(batch) < batch_size:
+                return
+            if remaining is not None:
+                remaining -= len(batch)
     
     async def create_branch(self, repo: Repository, branch_name: str, base_branch: str = "main") -> str:
-        base_ref = repo.get_git_ref(f"heads/{base_branch}")
-        repo.create_git_ref(
+        base_ref = await asyncio.to_thread(repo.get_git_ref, f"heads/{base_branch}")
+        await asyncio.to_thread(
+            repo.create_git_ref,
             ref=f"refs/heads/{branch_name}",
             sha=base_ref.object.sha
         )
@@ -105,20 +213,30 @@ class GitHubMCPConnector:
     
     async def update_file(self, repo: Repository, file_path: str, new_content: str, 
                           message: str, branch: str) -> Dict[str, Any]:
+        from github import GithubException
+        
         try:
-            file = repo.get_contents(file_path, ref=branch)
-            result = repo.update_file(
+            file = await asyncio.to_thread(repo.get_contents, file_path, ref=branch)
+        except GithubException as e:
+            if e.status != 404:
+                raise
+            file = None
+        
+        if file is None:
+            result = await asyncio.to_thread(
+                repo.create_file,
                 path=file_path,
                 message=message,
                 content=new_content,
-                sha=file.sha,
                 branch=branch
             )
-        except:
-            result = repo.create_file(
+        else:
+            result = await asyncio.to_thread(
+                repo.update_file,
                 path=file_path,
                 message=message,
                 content=new_content,
+                sha=file.sha,
                 branch=branch
             )
         
@@ -129,7 +247,8 @@ class GitHubMCPConnector:
     
     async def create_pull_request(self, repo: Repository, title: str, body: str, 
                                  head: str, base: str = "main") -> Dict[str, Any]:
-        pr = repo.create_pull(
+        pr = await asyncio.to_thread(
+            repo.create_pull,
             title=title,
             body=body,
             head=head,
@@ -143,4 +262,5 @@ class GitHubMCPConnector:
         }
     
     async def close(self):
-        await self.client.aclose()
\ No newline at end of file
+        if self._owns_client:
+            await self.client.aclose()
\ No newline at end of file
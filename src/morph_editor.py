@@ -1,13 +1,36 @@
+import asyncio
+import difflib
 import os
+import re
 import httpx
-from typing import Dict, List, Any, Optional
+from typing import Awaitable, Callable, Dict, List, Any, Optional
 from dataclasses import dataclass
 import json
-import google.generativeai as genai
 from dotenv import load_dotenv
 
 load_dotenv()
 
+genai = None
+
+def _load_genai():
+    global genai
+    if genai is None:
+        import google.generativeai
+        genai = google.generativeai
+    return genai
+
+DEFAULT_MAX_CONCURRENCY = 8
+MAX_REPORTED_CHANGES = 10
+_FENCE_RE = re.compile(r'^```[^\n]*\n(.*?)^```', re.DOTALL | re.MULTILINE)
+
+def _read_text(path: str) -> str:
+    with open(path, 'r') as f:
+        return f.read()
+
+def _write_text(path: str, content: str):
+    with open(path, 'w') as f:
+        f.write(content)
+
 @dataclass
 class EditRequest:
     file_path: str
@@ -24,20 +47,38 @@ class EditResult:
     error: Optional[str] = None
 
 class MorphLLMEditor:
-    def __init__(self):
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+    def __init__(self, client: Optional[httpx.AsyncClient] = None):
+        sdk = _load_genai()
+        sdk.configure(api_key=os.getenv("GEMINI_API_KEY"))
         model_name = os.getenv("GEMINI_MODEL", "gemini-2.5-flash-lite")
-        self.model = genai.GenerativeModel(model_name)
+        self.model = sdk.GenerativeModel(model_name)
         self.morph_api_key = os.getenv("MORPH_API_KEY", "")
-        self.client = httpx.AsyncClient(timeout=60)
+        self._owns_client = client is None
+        self.client = client or httpx.AsyncClient(timeout=60)
+    
+    async def apply_edits(self, repo_path: str, edits: List[EditRequest],
+                          max_concurrency: int = DEFAULT_MAX_CONCURRENCY) -> List[EditResult]:
+        return await self._apply_by_file(
+            edits,
+            lambda edit: self._apply_single_edit(repo_path, edit),
+            max_concurrency
+        )
     
-    async def apply_edits(self, repo_path: str, edits: List[EditRequest]) -> List[EditResult]:
-        results = []
+    async def _apply_by_file(self, edits: List[EditRequest],
+                             apply: Callable[[EditRequest], Awaitable[EditResult]],
+                             max_concurrency: int) -> List[EditResult]:
+        limit = asyncio.Semaphore(max_concurrency)
+        results: List[Optional[EditResult]] = [None] * len(edits)
+        groups: Dict[str, List[int]] = {}
+        for index, edit in enumerate(edits):
+            groups.setdefault(os.path.normpath(edit.file_path), []).append(index)
         
-        for edit in edits:
-            result = await self._apply_single_edit(repo_path, edit)
-            results.append(result)
+        async def apply_group(indices: List[int]):
+            async with limit:
+                for index in indices:
+                    results[index] = await apply(edits[index])
         
+        await asyncio.gather(*(apply_group(indices) for indices in groups.values()))
         return results
     
     async def _apply_single_edit(self, repo_path: str, edit: EditRequest) -> EditResult:
@@ -52,18 +93,19 @@ class MorphLLMEditor:
                     error=f"File not found: {edit.file_path}"
                 )
             
-            with open(full_path, 'r') as f:
-                current_content = f.read()
+            current_content = await asyncio.to_thread(_read_text, full_path)
             
-            modified_content = await self._generate_edit(
-                current_content,
-                edit.original_code,
-                edit.target_code,
-                edit.description
-            )
+            modified_content = self._replace_unique(current_content, edit.original_code, edit.target_code)
+            if modified_content is None:
+                modified_content = await self._generate_edit(
+                    current_content,
+                    edit.original_code,
+                    edit.target_code,
+                    edit.description
+                )
             
-            with open(full_path, 'w') as f:
-                f.write(modified_content)
+            if modified_content != current_content:
+                await asyncio.to_thread(_write_text, full_path, modified_content)
             
             changes = self._extract_changes(current_content, modified_content)
             
@@ -81,6 +123,16 @@ class MorphLLMEditor:
                 error=str(e)
             )
     
+    def _replace_unique(self, content: str, old_code: str, new_code: str) -> Optional[str]:
+        if not old_code:
+            return None
+        
+        start = content.find(old_code)
+        if start == -1 or content.find(old_code, start + 1) != -1:
+            return None
+        
+        return content[:start] + new_code + content[start + len(old_code):]
+    
     async def _generate_edit(self, full_content: str, old_code: str, 
                             new_code: str, description: str) -> str:
         prompt = f"""You are a code editor. Apply the following transformation to the code.
@@ -106,23 +158,12 @@ Return ONLY the complete modified file content, preserving all other parts uncha
 Maintain exact formatting, indentation, and structure of the original file.
 """
         
-        response = self.model.generate_content(prompt)
+        response = await asyncio.to_thread(self.model.generate_content, prompt)
         content = response.text
         
-        if "```" in content:
-            lines = content.split('\n')
-            start_idx = -1
-            end_idx = -1
-            
-            for i, line in enumerate(lines):
-                if line.startswith("```") and start_idx == -1:
-                    start_idx = i
-                elif line.startswith("```") and start_idx != -1:
-                    end_idx = i
-                    break
-            
-            if start_idx != -1 and end_idx != -1:
-                return '\n'.join(lines[start_idx+1:end_idx])
+        match = _FENCE_RE.search(content)
+        if match:
+            return match.group(1).removesuffix('\n')
         
         return content
     
@@ -131,44 +172,45 @@ Maintain exact formatting, indentation, and structure of the original file.
         modified_lines = modified.split('\n')
         changes = []
         
-        import difflib
-        differ = difflib.unified_diff(
-            original_lines,
-            modified_lines,
-            lineterm='',
-            n=0
-        )
-        
-        for line in differ:
-            if line.startswith('+') and not line.startswith('+++'):
-                changes.append(f"Added: {line[1:]}")
-            elif line.startswith('-') and not line.startswith('---'):
-                changes.append(f"Removed: {line[1:]}")
+        matcher = difflib.SequenceMatcher(a=original_lines, b=modified_lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag in ('replace', 'delete'):
+                changes.extend(f"Removed: {line}" for line in original_lines[i1:i2])
+            if tag in ('replace', 'insert'):
+                changes.extend(f"Added: {line}" for line in modified_lines[j1:j2])
+            if len(changes) >= MAX_REPORTED_CHANGES:
+                break
         
-        return changes[:10]
+        return changes[:MAX_REPORTED_CHANGES]
     
     async def batch_convert_files(self, repo_path: str, 
-                                 transformations: List[Dict[str, Any]]) -> Dict[str, Any]:
+                                 transformations: List[Dict[str, Any]],
+                                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY) -> Dict[str, Any]:
         total = len(transformations)
-        successful = 0
-        failed = 0
-        results = []
-        
-        for transform in transformations:
-            edit = EditRequest(
+        edits = [
+            EditRequest(
                 file_path=transform['file_path'],
                 original_code=transform['original_code'],
                 target_code=transform['transformed_code'],
                 description=transform.get('description', 'Convert to FlowGlad')
             )
-            
-            result = await self._apply_single_edit(repo_path, edit)
-            results.append(result)
-            
-            if result.success:
-                successful += 1
-            else:
-                failed += 1
+            for transform in transformations
+        ]
+        
+        async def convert(edit: EditRequest) -> EditResult:
+            try:
+                return await self._apply_single_edit(repo_path, edit)
+            except Exception as e:
+                return EditResult(
+                    success=False,
+                    file_path=edit.file_path,
+                    changes_made=[],
+                    error=str(e)
+                )
+        
+        results = await self._apply_by_file(edits, convert, max_concurrency)
+        successful = sum(1 for result in results if result.success)
+        failed = total - successful
         
         return {
             "total_files": total,
@@ -255,4 +297,8 @@ This PR migrates the payment processing from Stripe/Square to FlowGlad.
 - Review and test all payment flows before deployment
 """
         
-        return description
\ No newline at end of file
+        return description
+    
+    async def close(self):
+        if self._owns_client:
+            await self.client.aclose()
@@ -1,17 +1,22 @@
 import re
 import ast
-from typing import Dict, List, Any, Optional, Tuple
-from dataclasses import dataclass, field
-from enum import Enum
+import hashlib
+import threading
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+from dataclasses import dataclass, field, replace
+from enum import StrEnum
 
-class PaymentProvider(Enum):
+class PaymentProvider(StrEnum):
     STRIPE = "stripe"
     SQUARE = "square"
     PAYPAL = "paypal"
     BRAINTREE = "braintree"
     UNKNOWN = "unknown"
 
-@dataclass
+@dataclass(slots=True)
 class PaymentFlow:
     provider: PaymentProvider
     flow_type: str
@@ -24,16 +29,101 @@ class PaymentFlow:
     webhooks: List[str] = field(default_factory=list)
     api_keys: List[str] = field(default_factory=list)
     
-@dataclass
+@dataclass(slots=True)
 class PaymentPattern:
     pattern: str
     provider: PaymentProvider
     flow_type: str
     confidence: float
 
+ANALYSIS_CACHE_SIZE = 256
+
+PARALLEL_MIN_FILES = 32
+PARALLEL_CHUNK_SIZE = 16
+
+PROVIDER_KEYWORDS = ("stripe", "square", "paypal", "braintree")
+
+_JS_PATTERNS = [
+    (r"require\(['\"]stripe['\"]\)", PaymentProvider.STRIPE, "import"),
+    (r"import.*from ['\"]stripe['\"]", PaymentProvider.STRIPE, "import"),
+    (r"require\(['\"]square['\"]\)", PaymentProvider.SQUARE, "import"),
+    (r"import.*from ['\"]square['\"]", PaymentProvider.SQUARE, "import"),
+    (r"stripe\.customers\.create", PaymentProvider.STRIPE, "customer_creation"),
+    (r"stripe\.paymentIntents\.create", PaymentProvider.STRIPE, "payment_intent"),
+    (r"stripe\.subscriptions\.create", PaymentProvider.STRIPE, "subscription"),
+    (r"stripe\.checkout\.sessions\.create", PaymentProvider.STRIPE, "checkout"),
+    (r"square\.paymentsApi\.createPayment", PaymentProvider.SQUARE, "payment_creation"),
+    (r"square\.customersApi\.createCustomer", PaymentProvider.SQUARE, "customer_creation"),
+]
+
+_JAVA_PATTERNS = [
+    (r"import com\.stripe\.", PaymentProvider.STRIPE, "import"),
+    (r"import com\.squareup\.", PaymentProvider.SQUARE, "import"),
+    (r"Stripe\.apiKey", PaymentProvider.STRIPE, "initialization"),
+    (r"new SquareClient\.Builder", PaymentProvider.SQUARE, "initialization"),
+    (r"Customer\.create", PaymentProvider.STRIPE, "customer_creation"),
+    (r"PaymentIntent\.create", PaymentProvider.STRIPE, "payment_intent"),
+    (r"Subscription\.create", PaymentProvider.STRIPE, "subscription"),
+]
+
+_UPPERCASE_ESCAPE_RE = re.compile(r"(?<!\\)(?:\\\\)*\\[A-Z]")
+
+class _PatternSet:
+    def __init__(self, entries: List[Tuple[str, Any]], flags: int = 0):
+        self._entries = [(re.compile(pattern, flags), payload) for pattern, payload in entries]
+        self._folded = None
+        if flags & re.IGNORECASE:
+            for pattern, _ in entries:
+                if _UPPERCASE_ESCAPE_RE.search(pattern):
+                    raise ValueError(f"Caseless pattern cannot be lowercased safely: {pattern!r}")
+            self._folded = [re.compile(pattern.lower(), flags & ~re.IGNORECASE) for pattern, _ in entries]
+        self.master = re.compile(
+            "|".join(f"(?P<g{i}>{pattern})" for i, (pattern, _) in enumerate(entries)), flags
+        )
+    
+    def matching(self, text: str) -> List[Any]:
+        if self.master.search(text) is None:
+            return []
+        return [payload for pattern, payload in self._entries if pattern.search(text)]
+    
+    def scan(self, content: str, lowered: Optional[str] = None) -> Iterator[Tuple[int, str, List[Any]]]:
+        haystack = content
+        patterns = [pattern for pattern, _ in self._entries]
+        if self._folded is not None and content.isascii():
+            haystack = content.lower() if lowered is None else lowered
+            patterns = self._folded
+        
+        hits: Dict[int, Tuple[int, int, List[Any]]] = {}
+        for pattern, (_, payload) in zip(patterns, self._entries):
+            lineno = 1
+            line_start = 0
+            match = pattern.search(haystack)
+            while match is not None:
+                lineno += content.count('\n', line_start, match.start())
+                line_start = content.rfind('\n', 0, match.start()) + 1
+                line_end = content.find('\n', match.start())
+                if line_end == -1:
+                    line_end = len(content)
+                hits.setdefault(lineno, (line_start, line_end, []))[2].append(payload)
+                match = pattern.search(haystack, line_end + 1)
+        
+        for lineno in sorted(hits):
+            line_start, line_end, payloads = hits[lineno]
+            yield lineno, content[line_start:line_end], payloads
+
+_JS_PATTERN_SET = _PatternSet(
+    [(pattern, (provider, flow_type)) for pattern, provider, flow_type in _JS_PATTERNS], re.IGNORECASE
+)
+_JAVA_PATTERN_SET = _PatternSet(
+    [(pattern, (provider, flow_type)) for pattern, provider, flow_type in _JAVA_PATTERNS]
+)
+
 class PaymentLogicAnalyzer:
     def __init__(self):
         self.patterns = self._initialize_patterns()
+        self._pattern_set = _PatternSet([(p.pattern, p) for p in self.patterns])
+        self._analysis_cache: "OrderedDict[Tuple[str, bytes], List[PaymentFlow]]" = OrderedDict()
+        self._analysis_cache_lock = threading.Lock()
         
     def _initialize_patterns(self) -> List[PaymentPattern]:
         return [
@@ -63,22 +153,65 @@ class PaymentLogicAnalyzer:
         flows = []
         
         if file_path.endswith('.py'):
-            flows.extend(self._analyze_python(file_path, content))
+            language = "python"
         elif file_path.endswith(('.js', '.ts', '.jsx', '.tsx')):
-            flows.extend(self._analyze_javascript(file_path, content))
+            language = "javascript"
         elif file_path.endswith(('.java', '.kt')):
-            flows.extend(self._analyze_java(file_path, content))
+            language = "java"
+        else:
+            return flows
         
+        lowered = None
+        if not any(keyword in content for keyword in PROVIDER_KEYWORDS):
+            lowered = content.lower()
+            if not any(keyword in lowered for keyword in PROVIDER_KEYWORDS):
+                return flows
+        
+        key = (language, hashlib.blake2b(content.encode('utf-8', 'surrogatepass'), digest_size=16).digest())
+        with self._analysis_cache_lock:
+            cached = self._analysis_cache.get(key)
+            if cached is not None:
+                self._analysis_cache.move_to_end(key)
+        
+        if cached is None:
+            if language == "python":
+                cached = self._analyze_python(file_path, content)
+            elif language == "javascript":
+                cached = self._analyze_javascript(file_path, content, lowered)
+            else:
+                cached = self._analyze_java(file_path, content)
+            with self._analysis_cache_lock:
+                self._analysis_cache[key] = cached
+                if len(self._analysis_cache) > ANALYSIS_CACHE_SIZE:
+                    self._analysis_cache.popitem(last=False)
+        
+        flows.extend(self._copy_flow(flow, file_path) for flow in cached)
         return flows
     
+    def analyze_files(self, items: List[Tuple[str, str]], max_workers: Optional[int] = None) -> List[PaymentFlow]:
+        if len(items) < PARALLEL_MIN_FILES or max_workers == 1:
+            results = [self.analyze_file(file_path, content) for file_path, content in items]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(_analyze_item, items, chunksize=PARALLEL_CHUNK_SIZE))
+        
+        return [flow for flows in results for flow in flows]
+    
+    def clear_cache(self):
+        with self._analysis_cache_lock:
+            self._analysis_cache.clear()
+    
     def _analyze_python(self, file_path: str, content: str) -> List[PaymentFlow]:
         flows = []
-        lines = content.split('\n')
         
         try:
             tree = ast.parse(content)
             
-            for node in ast.walk(tree):
+            queue = deque([tree])
+            enclosing = {}
+            while queue:
+                node = queue.popleft()
+                functions = enclosing.pop(node, ())
                 if isinstance(node, ast.Import):
                     for alias in node.names:
                         if 'stripe' in alias.name.lower():
@@ -89,102 +222,67 @@ class PaymentLogicAnalyzer:
                             flows.append(flow)
                 
                 elif isinstance(node, ast.Call):
-                    call_str = self._get_call_string(node, lines)
-                    for pattern in self.patterns:
-                        if re.search(pattern.pattern, call_str):
-                            flow = self._create_flow(
-                                pattern.provider, 
-                                pattern.flow_type, 
-                                file_path, 
-                                node.lineno
-                            )
-                            flow.methods.append(call_str)
-                            flows.append(flow)
+                    call_str = self._get_call_string(node)
+                    for pattern in self._pattern_set.matching(call_str):
+                        flow = self._create_flow(
+                            pattern.provider,
+                            pattern.flow_type,
+                            file_path,
+                            node.lineno
+                        )
+                        flow.methods.append(call_str)
+                        flows.append(flow)
+                        for function_flow in functions:
+                            function_flow.provider = pattern.provider
+                            function_flow.flow_type = pattern.flow_type
+                            function_flow.methods.append(call_str)
                             
                 elif isinstance(node, ast.FunctionDef):
                     func_name = node.name.lower()
                     if any(keyword in func_name for keyword in ['payment', 'charge', 'subscription', 'checkout', 'billing']):
-                        flow = self._analyze_function(node, file_path, lines)
-                        if flow:
-                            flows.append(flow)
+                        flow = self._create_flow(PaymentProvider.UNKNOWN, "unknown", file_path, node.lineno)
+                        flow.line_end = node.end_lineno or node.lineno
+                        flows.append(flow)
+                        functions = functions + (flow,)
+                
+                children = ast.iter_child_nodes(node)
+                if functions:
+                    children = list(children)
+                    enclosing.update(dict.fromkeys(children, functions))
+                queue.extend(children)
         
         except SyntaxError:
             flows.extend(self._fallback_analysis(file_path, content))
         
-        return flows
-    
-    def _analyze_javascript(self, file_path: str, content: str) -> List[PaymentFlow]:
-        flows = []
-        lines = content.split('\n')
-        
-        js_patterns = [
-            (r"require\(['\"]stripe['\"]\)", PaymentProvider.STRIPE, "import"),
-            (r"import.*from ['\"]stripe['\"]", PaymentProvider.STRIPE, "import"),
-            (r"require\(['\"]square['\"]\)", PaymentProvider.SQUARE, "import"),
-            (r"import.*from ['\"]square['\"]", PaymentProvider.SQUARE, "import"),
-            (r"stripe\.customers\.create", PaymentProvider.STRIPE, "customer_creation"),
-            (r"stripe\.paymentIntents\.create", PaymentProvider.STRIPE, "payment_intent"),
-            (r"stripe\.subscriptions\.create", PaymentProvider.STRIPE, "subscription"),
-            (r"stripe\.checkout\.sessions\.create", PaymentProvider.STRIPE, "checkout"),
-            (r"square\.paymentsApi\.createPayment", PaymentProvider.SQUARE, "payment_creation"),
-            (r"square\.customersApi\.createCustomer", PaymentProvider.SQUARE, "customer_creation"),
-        ]
-        
-        for i, line in enumerate(lines, 1):
-            for pattern, provider, flow_type in js_patterns:
-                if re.search(pattern, line, re.IGNORECASE):
-                    flow = self._create_flow(provider, flow_type, file_path, i)
-                    flow.methods.append(line.strip())
-                    flows.append(flow)
+        seen = set()
+        unique_flows = []
+        for flow in flows:
+            key = (flow.provider, flow.flow_type, flow.line_start, flow.line_end, tuple(flow.methods))
+            if flow.provider != PaymentProvider.UNKNOWN and key not in seen:
+                seen.add(key)
+                unique_flows.append(flow)
         
-        return flows
+        return unique_flows
+    
+    def _analyze_javascript(self, file_path: str, content: str, lowered: Optional[str] = None) -> List[PaymentFlow]:
+        return self._scan_content(_JS_PATTERN_SET, file_path, content, lowered)
     
     def _analyze_java(self, file_path: str, content: str) -> List[PaymentFlow]:
+        return self._scan_content(_JAVA_PATTERN_SET, file_path, content)
+    
+    def _scan_content(self, pattern_set: _PatternSet, file_path: str, content: str,
+                      lowered: Optional[str] = None) -> List[PaymentFlow]:
         flows = []
-        lines = content.split('\n')
-        
-        java_patterns = [
-            (r"import com\.stripe\.", PaymentProvider.STRIPE, "import"),
-            (r"import com\.squareup\.", PaymentProvider.SQUARE, "import"),
-            (r"Stripe\.apiKey", PaymentProvider.STRIPE, "initialization"),
-            (r"new SquareClient\.Builder", PaymentProvider.SQUARE, "initialization"),
-            (r"Customer\.create", PaymentProvider.STRIPE, "customer_creation"),
-            (r"PaymentIntent\.create", PaymentProvider.STRIPE, "payment_intent"),
-            (r"Subscription\.create", PaymentProvider.STRIPE, "subscription"),
-        ]
         
-        for i, line in enumerate(lines, 1):
-            for pattern, provider, flow_type in java_patterns:
-                if re.search(pattern, line):
-                    flow = self._create_flow(provider, flow_type, file_path, i)
-                    flow.methods.append(line.strip())
-                    flows.append(flow)
+        for i, line, matches in pattern_set.scan(content, lowered):
+            for provider, flow_type in matches:
+                flow = self._create_flow(provider, flow_type, file_path, i)
+                flow.methods.append(line.strip())
+                flows.append(flow)
         
         return flows
     
-    def _analyze_function(self, node: ast.FunctionDef, file_path: str, lines: List[str]) -> Optional[PaymentFlow]:
-        provider = PaymentProvider.UNKNOWN
-        flow_type = "unknown"
-        methods = []
-        
-        for child in ast.walk(node):
-            if isinstance(child, ast.Call):
-                call_str = self._get_call_string(child, lines)
-                for pattern in self.patterns:
-                    if re.search(pattern.pattern, call_str):
-                        provider = pattern.provider
-                        flow_type = pattern.flow_type
-                        methods.append(call_str)
-        
-        if provider != PaymentProvider.UNKNOWN:
-            flow = self._create_flow(provider, flow_type, file_path, node.lineno)
-            flow.line_end = node.end_lineno or node.lineno
-            flow.methods = methods
-            return flow
-        
-        return None
-    
-    def _get_call_string(self, node: ast.Call, lines: List[str]) -> str:
+    def _get_call_string(self, node: ast.Call) -> str:
         if hasattr(node.func, 'id'):
             return node.func.id
         elif hasattr(node.func, 'attr'):
@@ -200,6 +298,17 @@ class PaymentLogicAnalyzer:
             return '.'.join(reversed(parts))
         return ""
     
+    def _copy_flow(self, flow: PaymentFlow, file_path: str) -> PaymentFlow:
+        return replace(
+            flow,
+            file_path=file_path,
+            methods=list(flow.methods),
+            endpoints=list(flow.endpoints),
+            models=list(flow.models),
+            webhooks=list(flow.webhooks),
+            api_keys=list(flow.api_keys)
+        )
+    
     def _create_flow(self, provider: PaymentProvider, flow_type: str, 
                     file_path: str, line_start: int) -> PaymentFlow:
         return PaymentFlow(
@@ -212,55 +321,53 @@ class PaymentLogicAnalyzer:
     
     def _fallback_analysis(self, file_path: str, content: str) -> List[PaymentFlow]:
         flows = []
-        lines = content.split('\n')
         
-        for i, line in enumerate(lines, 1):
-            for pattern in self.patterns:
-                if re.search(pattern.pattern, line):
-                    flow = self._create_flow(
-                        pattern.provider,
-                        pattern.flow_type,
-                        file_path,
-                        i
-                    )
-                    flow.methods.append(line.strip())
-                    flows.append(flow)
+        for i, line, patterns in self._pattern_set.scan(content):
+            for pattern in patterns:
+                flow = self._create_flow(
+                    pattern.provider,
+                    pattern.flow_type,
+                    file_path,
+                    i
+                )
+                flow.methods.append(line.strip())
+                flows.append(flow)
         
         return flows
     
     def extract_payment_architecture(self, flows: List[PaymentFlow]) -> Dict[str, Any]:
-        architecture = {
-            "providers": {},
-            "endpoints": [],
-            "webhooks": [],
-            "models": [],
-            "flow_summary": {}
-        }
+        providers = defaultdict(lambda: {"flows": [], "files": set(), "methods": set()})
+        flow_summary = Counter()
+        endpoints = []
+        webhooks = []
+        models = []
         
         for flow in flows:
-            provider_name = flow.provider.value
-            
-            if provider_name not in architecture["providers"]:
-                architecture["providers"][provider_name] = {
-                    "flows": [],
-                    "files": set(),
-                    "methods": set()
-                }
+            provider = providers[flow.provider]
+            provider["flows"].append(flow.flow_type)
+            provider["files"].add(flow.file_path)
+            provider["methods"].update(flow.methods)
             
-            architecture["providers"][provider_name]["flows"].append(flow.flow_type)
-            architecture["providers"][provider_name]["files"].add(flow.file_path)
-            architecture["providers"][provider_name]["methods"].update(flow.methods)
-            
-            architecture["endpoints"].extend(flow.endpoints)
-            architecture["webhooks"].extend(flow.webhooks)
-            architecture["models"].extend(flow.models)
-            
-            if flow.flow_type not in architecture["flow_summary"]:
-                architecture["flow_summary"][flow.flow_type] = 0
-            architecture["flow_summary"][flow.flow_type] += 1
-        
-        for provider in architecture["providers"]:
-            architecture["providers"][provider]["files"] = list(architecture["providers"][provider]["files"])
-            architecture["providers"][provider]["methods"] = list(architecture["providers"][provider]["methods"])
+            endpoints.extend(flow.endpoints)
+            webhooks.extend(flow.webhooks)
+            models.extend(flow.models)
+            flow_summary[flow.flow_type] += 1
         
-        return architecture
\ No newline at end of file
+        return {
+            "providers": {
+                name.value: {"flows": provider["flows"], "files": list(provider["files"]), "methods": list(provider["methods"])}
+                for name, provider in providers.items()
+            },
+            "endpoints": endpoints,
+            "webhooks": webhooks,
+            "models": models,
+            "flow_summary": dict(flow_summary)
+        }
+
+@lru_cache(maxsize=None)
+def _worker_analyzer() -> PaymentLogicAnalyzer:
+    return PaymentLogicAnalyzer()
+
+def _analyze_item(item: Tuple[str, str]) -> List[PaymentFlow]:
+    file_path, content = item
+    return _worker_analyzer().analyze_file(file_path, content)
\ No newline at end of file
@@ -1,8 +1,7 @@
 import pytest
+import asyncio
 from unittest.mock import Mock, patch, AsyncMock, MagicMock
-import sys
 import os
-sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 from agent import (
     FlowGladMigrationAgent, 
@@ -14,6 +13,11 @@ from payment_analyzer import PaymentFlow, PaymentProvider
 from flowglad_converter import CodeTransformation
 
 
+async def _stream(items):
+    for item in items:
+        yield item
+
+
 @pytest.fixture
 def agent_config():
     return AgentConfig(
@@ -40,14 +44,12 @@ def agent(agent_config):
 class TestFlowGladMigrationAgent:
     
     @pytest.mark.integration
-    @pytest.mark.asyncio
-    async def test_agent_initialization(self, agent, agent_config):
+    def test_agent_initialization(self, agent, agent_config):
         assert agent.config == agent_config
         assert agent.status == AgentStatus.IDLE
         assert agent.report is None
     
     @pytest.mark.integration
-    @pytest.mark.asyncio
     async def test_successful_migration_flow(self, agent):
         # Mock authentication
         with patch.object(agent.mcp_connector, 'authenticate', new_callable=AsyncMock) as mock_auth:
@@ -108,7 +110,6 @@ class TestFlowGladMigrationAgent:
                                 assert agent.status == AgentStatus.COMPLETE
     
     @pytest.mark.integration
-    @pytest.mark.asyncio
     async def test_authentication_failure(self, agent):
         with patch.object(agent.mcp_connector, 'authenticate', new_callable=AsyncMock) as mock_auth:
             mock_auth.return_value = False
@@ -119,7 +120,6 @@ class TestFlowGladMigrationAgent:
             assert agent.status == AgentStatus.ERROR
     
     @pytest.mark.integration
-    @pytest.mark.asyncio
     async def test_analyze_repository(self, agent):
         mock_repo = Mock()
         mock_repo.full_name = "test/repo"
@@ -132,8 +132,8 @@ class TestFlowGladMigrationAgent:
                 {"path": "checkout.js", "repository": "test/repo", "sha": "def456", "score": 0.9}
             ]
             
-            with patch.object(agent.mcp_connector, 'search_payment_files', new_callable=AsyncMock) as mock_search:
-                mock_search.return_value = mock_payment_files
+            with patch.object(agent.mcp_connector, 'iter_payment_files') as mock_search:
+                mock_search.return_value = _stream(mock_payment_files)
                 
                 with patch.object(agent.mcp_connector, 'get_file_content', new_callable=AsyncMock) as mock_get_content:
                     mock_get_content.side_effect = [
@@ -147,9 +147,41 @@ class TestFlowGladMigrationAgent:
                     mock_get_repo.assert_called_once_with("test/repo")
                     mock_search.assert_called_once()
                     assert mock_get_content.call_count == 2
-    
+
+    @pytest.mark.integration
+    async def test_analyze_repository_isolates_fetch_errors(self, agent):
+        mock_payment_files = [
+            {"path": "broken.py", "repository": "test/repo", "sha": "abc123", "score": 1.0},
+            {"path": "payment.py", "repository": "test/repo", "sha": "def456", "score": 0.9}
+        ]
+
+        with patch.object(agent.mcp_connector, 'get_repository', new_callable=AsyncMock):
+            with patch.object(agent.mcp_connector, 'iter_payment_files') as mock_search:
+                mock_search.return_value = _stream(mock_payment_files)
+
+                with patch.object(agent.mcp_connector, 'get_file_content', new_callable=AsyncMock) as mock_get_content:
+                    mock_get_content.side_effect = [
+                        Exception("Not found"),
+                        "import stripe\nstripe.Customer.create()"
+                    ]
+
+                    flows = await agent._analyze_repository()
+
+                    assert len(flows) > 0
+                    assert all(f.file_path == "payment.py" for f in flows)
+
+    @pytest.mark.integration
+    async def test_analyze_repository_surfaces_search_errors(self, agent):
+        async def search(repo):
+            raise RuntimeError("403 rate limit exceeded")
+            yield
+
+        with patch.object(agent.mcp_connector, 'get_repository', new_callable=AsyncMock):
+            with patch.object(agent.mcp_connector, 'iter_payment_files', side_effect=search):
+                with pytest.raises(RuntimeError, match="rate limit exceeded"):
+                    await agent._analyze_repository()
+
     @pytest.mark.integration
-    @pytest.mark.asyncio
     async def test_map_flows(self, agent):
         mock_flow = PaymentFlow(
             provider=PaymentProvider.STRIPE,
@@ -181,7 +213,92 @@ class TestFlowGladMigrationAgent:
                         assert flow_maps[0]["comparison"] == mock_comparison
     
     @pytest.mark.integration
-    @pytest.mark.asyncio
+    async def test_map_flows_batches_llm_calls(self, agent):
+        flows = [
+            PaymentFlow(
+                provider=PaymentProvider.STRIPE,
+                flow_type="payment",
+                file_path=f"payment_{i}.py",
+                line_start=1,
+                line_end=10
+            )
+            for i in range(8)
+        ]
+        
+        with patch.object(agent.mcp_connector, 'get_repository', new_callable=AsyncMock):
+            with patch.object(agent.mcp_connector, 'get_file_content', new_callable=AsyncMock) as mock_get_content:
+                mock_get_content.return_value = "stripe.Customer.create()"
+                
+                with patch.object(agent.mapper, 'map_payment_flows_batch') as mock_batch:
+                    mock_batch.side_effect = lambda items, namespace: [Mock() for _ in items]
+                    
+                    with patch.object(agent.mapper, 'compare_with_flowglad', return_value={}):
+                        flow_maps = await agent._map_flows(flows)
+                        
+                        assert len(flow_maps) == 8
+                        assert [m["flow"] for m in flow_maps] == flows
+                        assert mock_batch.call_count == 2
+    
+    @pytest.mark.integration
+    async def test_map_flows_keeps_batch_when_one_fetch_fails(self, agent):
+        flows = [
+            PaymentFlow(
+                provider=PaymentProvider.STRIPE,
+                flow_type="payment",
+                file_path=f"payment_{i}.py",
+                line_start=1,
+                line_end=10
+            )
+            for i in range(6)
+        ]
+        
+        async def get_file_content(repo, path):
+            if path == "payment_2.py":
+                raise Exception("Not found")
+            return "stripe.Customer.create()"
+        
+        with patch.object(agent.mcp_connector, 'get_repository', new_callable=AsyncMock):
+            with patch.object(agent.mcp_connector, 'get_file_content', side_effect=get_file_content):
+                with patch.object(agent.mapper, 'map_payment_flows_batch') as mock_batch:
+                    mock_batch.side_effect = lambda items, namespace: [Mock() for _ in items]
+                    
+                    with patch.object(agent.mapper, 'compare_with_flowglad', return_value={}):
+                        flow_maps = await agent._map_flows(flows)
+                        
+                        assert [m["flow"] for m in flow_maps] == flows[:2] + flows[3:]
+                        mock_batch.assert_called_once()
+                        assert len(mock_batch.call_args[0][0]) == 5
+    
+    @pytest.mark.integration
+    async def test_map_flows_falls_back_to_single_flows_when_batch_raises(self, agent):
+        flows = [
+            PaymentFlow(
+                provider=PaymentProvider.STRIPE,
+                flow_type="payment",
+                file_path=f"payment_{i}.py",
+                line_start=1,
+                line_end=10
+            )
+            for i in range(3)
+        ]
+        
+        def map_payment_flow(code, provider, flow_type, namespace):
+            if code == "broken":
+                raise ValueError("blocked")
+            return Mock()
+        
+        with patch.object(agent.mcp_connector, 'get_repository', new_callable=AsyncMock):
+            with patch.object(agent.mcp_connector, 'get_file_content', new_callable=AsyncMock) as mock_get_content:
+                mock_get_content.side_effect = ["stripe.Customer.create()", "broken", "stripe.Refund.create()"]
+                
+                with patch.object(agent.mapper, 'map_payment_flows_batch', side_effect=RuntimeError("batch failed")):
+                    with patch.object(agent.mapper, 'map_payment_flow', side_effect=map_payment_flow):
+                        with patch.object(agent.mapper, 'compare_with_flowglad', return_value={}):
+                            flow_maps = await agent._map_flows(flows)
+                            
+                            assert [m["flow"] for m in flow_maps] == [flows[0], flows[2]]
+    
+    @pytest.mark.integration
     async def test_convert_code(self, agent):
         mock_flows = [
             PaymentFlow(
@@ -235,7 +352,6 @@ class TestFlowGladMigrationAgent:
                     assert transformations[1].file_path == "checkout.py"
     
     @pytest.mark.integration
-    @pytest.mark.asyncio
     async def test_apply_changes(self, agent):
         mock_transformations = [
             CodeTransformation(
@@ -345,11 +461,193 @@ class TestFlowGladMigrationAgent:
         assert report.pr_url == pr_url
     
     @pytest.mark.integration
-    @pytest.mark.asyncio
+    def test_display_report_emits_tsv_when_not_a_terminal(self, agent, capsys):
+        report = MigrationReport(
+            repo_name="test/repo",
+            files_analyzed=2,
+            payment_flows_found=3,
+            files_converted=2,
+            conversion_success_rate=1.0
+        )
+        
+        agent._display_report(report)
+        
+        lines = capsys.readouterr().out.splitlines()
+        assert lines[0] == "Repository\ttest/repo"
+        assert "Success Rate\t100.0%" in lines
+        assert not any(line.startswith("Pull Request") for line in lines)
+    
+    @pytest.mark.integration
     async def test_close(self, agent):
         with patch.object(agent.mcp_connector, 'close', new_callable=AsyncMock) as mock_close:
             with patch.object(agent.editor.client, 'aclose', new_callable=AsyncMock) as mock_editor_close:
                 await agent.close()
                 
                 mock_close.assert_called_once()
-                mock_editor_close.assert_called_once()
\ No newline at end of file
+                mock_editor_close.assert_called_once()
+    
+    @pytest.mark.integration
+    async def test_repository_is_fetched_once(self, agent):
+        with patch.object(agent.mcp_connector, 'get_repository', new_callable=AsyncMock) as mock_get_repo:
+            mock_get_repo.return_value = Mock()
+            
+            with patch.object(agent.mcp_connector, 'get_file_content', new_callable=AsyncMock) as mock_get_content:
+                mock_get_content.return_value = "import stripe"
+                
+                flows = [
+                    PaymentFlow(
+                        provider=PaymentProvider.STRIPE,
+                        flow_type="payment",
+                        file_path="payment.py",
+                        line_start=1,
+                        line_end=10
+                    )
+                ]
+                await agent._convert_code(flows)
+                await agent._convert_code(flows)
+                
+                mock_get_repo.assert_called_once_with("test/repo")
+    
+    @pytest.mark.integration
+    async def test_concurrent_fetches_share_one_request(self, agent):
+        async def get_file_content(repo, path):
+            await asyncio.sleep(0)
+            return "import stripe"
+        
+        with patch.object(agent.mcp_connector, 'get_repository', new_callable=AsyncMock) as mock_get_repo:
+            with patch.object(agent.mcp_connector, 'get_file_content', side_effect=get_file_content) as mock_get_content:
+                repos = await asyncio.gather(agent._get_repo(), agent._get_repo())
+                contents = await asyncio.gather(*(agent._get_content(repos[0], "payment.py") for _ in range(3)))
+                
+                assert contents == ["import stripe"] * 3
+                mock_get_repo.assert_called_once_with("test/repo")
+                mock_get_content.assert_called_once()
+    
+    @pytest.mark.integration
+    async def test_failed_fetch_is_retried(self, agent):
+        with patch.object(agent.mcp_connector, 'get_repository', new_callable=AsyncMock):
+            with patch.object(agent.mcp_connector, 'get_file_content', new_callable=AsyncMock) as mock_get_content:
+                mock_get_content.side_effect = [Exception("timeout"), "import stripe"]
+                repo = await agent._get_repo()
+                
+                with pytest.raises(Exception, match="timeout"):
+                    await agent._get_content(repo, "payment.py")
+                
+                assert await agent._get_content(repo, "payment.py") == "import stripe"
+    
+    @pytest.mark.integration
+    async def test_file_content_is_reused_across_phases(self, agent):
+        with patch.object(agent.mcp_connector, 'get_repository', new_callable=AsyncMock):
+            with patch.object(agent.mcp_connector, 'iter_payment_files') as mock_search:
+                mock_search.return_value = _stream([
+                    {"path": "payment.py", "repository": "test/repo", "sha": "abc123", "score": 1.0}
+                ])
+                
+                with patch.object(agent.mcp_connector, 'get_file_content', new_callable=AsyncMock) as mock_get_content:
+                    mock_get_content.return_value = "import stripe\nstripe.Customer.create()"
+                    
+                    flows = await agent._analyze_repository()
+                    transformations = await agent._convert_code(flows)
+                    
+                    assert len(transformations) == 1
+                    mock_get_content.assert_called_once()
+    
+    @pytest.mark.integration
+    async def test_mapping_and_conversion_overlap(self, agent):
+        agent.config.auto_apply = False
+        conversion_started = asyncio.Event()
+        
+        async def map_flows(flows):
+            await asyncio.wait_for(conversion_started.wait(), timeout=1)
+            return []
+        
+        async def convert_code(flows):
+            conversion_started.set()
+            return []
+        
+        with patch.object(agent, '_authenticate', new_callable=AsyncMock):
+            with patch.object(agent, '_analyze_repository', new_callable=AsyncMock) as mock_analyze:
+                mock_analyze.return_value = []
+                
+                with patch.object(agent, '_map_flows', side_effect=map_flows):
+                    with patch.object(agent, '_convert_code', side_effect=convert_code):
+                        report = await agent.run()
+                        
+                        assert report.files_converted == 0
+                        assert agent.status == AgentStatus.COMPLETE
+    
+    @pytest.mark.integration
+    async def test_status_moves_to_converting_once_mapping_finishes(self, agent):
+        agent.config.auto_apply = False
+        
+        async def convert_code(flows):
+            while agent.status is not AgentStatus.CONVERTING:
+                await asyncio.sleep(0)
+            return []
+        
+        with patch.object(agent, '_authenticate', new_callable=AsyncMock):
+            with patch.object(agent, '_analyze_repository', new_callable=AsyncMock) as mock_analyze:
+                mock_analyze.return_value = []
+                
+                with patch.object(agent, '_map_flows', new_callable=AsyncMock) as mock_map:
+                    mock_map.return_value = []
+                    
+                    with patch.object(agent, '_convert_code', side_effect=convert_code):
+                        await asyncio.wait_for(agent.run(), timeout=1)
+                        
+                        assert agent.status == AgentStatus.COMPLETE
+    
+    @pytest.mark.integration
+    async def test_run_surfaces_mapping_errors_unwrapped(self, agent):
+        with patch.object(agent, '_authenticate', new_callable=AsyncMock):
+            with patch.object(agent, '_analyze_repository', new_callable=AsyncMock) as mock_analyze:
+                mock_analyze.return_value = []
+                
+                with patch.object(agent, '_map_flows', side_effect=RuntimeError("quota exhausted")):
+                    with patch.object(agent, '_convert_code', new_callable=AsyncMock):
+                        with pytest.raises(RuntimeError, match="quota exhausted"):
+                            await agent.run()
+                        
+                        assert agent.status == AgentStatus.ERROR
+    
+    @pytest.mark.integration
+    async def test_http_client_is_shared(self, agent):
+        assert agent.mcp_connector.client is agent.editor.client
+        
+        with patch.object(agent.mcp_connector.client, 'aclose', new_callable=AsyncMock) as mock_aclose:
+            await agent.close()
+            
+            mock_aclose.assert_called_once()
+    
+    @pytest.mark.integration
+    async def test_convert_code_isolates_conversion_errors(self, agent):
+        flows = [
+            PaymentFlow(
+                provider=PaymentProvider.STRIPE,
+                flow_type="payment",
+                file_path=path,
+                line_start=1,
+                line_end=10
+            )
+            for path in ("broken.py", "payment.py")
+        ]
+        
+        with patch.object(agent.mcp_connector, 'get_repository', new_callable=AsyncMock):
+            with patch.object(agent.mcp_connector, 'get_file_content', new_callable=AsyncMock) as mock_get_content:
+                mock_get_content.return_value = "import stripe"
+                
+                with patch.object(agent.converter, 'convert_code') as mock_convert:
+                    mock_convert.side_effect = [
+                        ValueError("unsupported"),
+                        CodeTransformation(
+                            original_code="import stripe",
+                            transformed_code="import flowglad",
+                            file_path="",
+                            line_range=(0, 1),
+                            transformation_type="full_file"
+                        )
+                    ]
+                    
+                    transformations = await agent._convert_code(flows)
+                    
+                    assert [t.file_path for t in transformations] == ["payment.py"]
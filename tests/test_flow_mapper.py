@@ -1,25 +1,160 @@
 import pytest
 from unittest.mock import Mock, patch, MagicMock
 import json
-import sys
+from dataclasses import replace
 import os
-sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 from flow_mapper import PaymentFlowMapper, PaymentFlowMap
 
 
-@pytest.fixture
+_PAYMENT_FLOW_RESPONSE = json.dumps({
+    "flow_description": "Customer creation and payment",
+    "steps": [
+        {"description": "Create customer", "code_reference": "line 1"},
+        {"description": "Create payment intent", "code_reference": "line 2"}
+    ],
+    "entities": ["customer", "payment_intent"],
+    "api_calls": ["stripe.Customer.create", "stripe.PaymentIntent.create"],
+    "business_logic": "Create customer then charge payment",
+    "validation_rules": ["Email validation", "Amount validation"],
+    "error_handling": ["Handle API errors"]
+})
+_CUSTOMER_CREATION_RESPONSE = json.dumps({"flow_description": "Customer creation"})
+_BATCH_RESPONSE = json.dumps([
+    {"flow_description": "Customer creation"},
+    {"flow_description": "Refund"},
+    {"flow_description": "Subscription"}
+])
+_SHORT_BATCH_RESPONSE = json.dumps([{"flow_description": "Only one"}])
+_PAIR_BATCH_RESPONSE = json.dumps([{"flow_description": "Customer creation"}, {"flow_description": "Refund"}])
+_SINGLE_RESPONSE = json.dumps({"flow_description": "Single"})
+_JSON_BLOCK_RESPONSE = """
+        Here's the analysis:
+        ```json
+        {
+            "flow_description": "Test flow",
+            "steps": [],
+            "entities": [],
+            "api_calls": [],
+            "business_logic": "Test logic",
+            "validation_rules": [],
+            "error_handling": []
+        }
+        ```
+        """
+_UNLABELLED_FENCE_RESPONSE = """```
+{"flow_description": "Nested", "steps": [{"description": "Charge"}], "business_logic": "Test logic"}
+```
+Let me know if you need anything else."""
+_QUOTED_SNIPPET_RESPONSE = """The original call passes:
+```
+{ amount: 1000, currency: 'usd' }
+```
+Analysis:
+```json
+{"flow_description": "Real", "steps": []}
+```"""
+
+_DOCUMENTATION_MAP = PaymentFlowMap(
+    original_provider="stripe",
+    flow_description="Payment processing flow",
+    steps=[
+        {"description": "Validate input"},
+        {"description": "Process payment", "code_reference": "payment.py:25"}
+    ],
+    entities=["customer", "payment"],
+    api_calls=["stripe.PaymentIntent.create"],
+    business_logic="Process customer payment",
+    validation_rules=["Amount > 0", "Valid card"],
+    error_handling=["Retry on timeout", "Log failures"]
+)
+_DOCUMENTATION_EXPECTED = (
+    "# Payment Flow Documentation",
+    "stripe",
+    "Validate input",
+    "customer, payment",
+    "stripe.PaymentIntent.create",
+    "Amount > 0",
+    "Retry on timeout"
+)
+_BASE_FLOW_MAP = PaymentFlowMap(
+    original_provider="stripe",
+    flow_description="",
+    steps=(),
+    entities=(),
+    api_calls=(),
+    business_logic="",
+    validation_rules=(),
+    error_handling=()
+)
+_STRIPE_COMPARE_MAP = replace(
+    _BASE_FLOW_MAP,
+    entities=("customer",),
+    api_calls=("stripe.Customer.create", "stripe.PaymentIntent.create"),
+    validation_rules=("Email validation",)
+)
+_SQUARE_COMPARE_MAP = replace(
+    _BASE_FLOW_MAP,
+    original_provider="square",
+    entities=("payment",),
+    api_calls=("square.payments_api.create_payment",)
+)
+
+
+@pytest.fixture(scope="module", autouse=True)
 def mock_genai():
-    with patch('flow_mapper.genai') as mock:
-        yield mock
+    patcher = patch('flow_mapper.genai')
+    mock = patcher.start()
+    yield mock
+    patcher.stop()
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def mapper(mock_genai):
     with patch.dict(os.environ, {'GEMINI_API_KEY': 'test_key', 'GEMINI_MODEL': 'gemini-2.5-flash-lite'}):
         return PaymentFlowMapper()
 
 
+@pytest.fixture(scope="module")
+def llm_canned():
+    return {
+        "payment_flow": Mock(text=_PAYMENT_FLOW_RESPONSE),
+        "customer_creation": Mock(text=_CUSTOMER_CREATION_RESPONSE),
+        "batch": Mock(text=_BATCH_RESPONSE),
+        "short_batch": Mock(text=_SHORT_BATCH_RESPONSE),
+        "pair_batch": Mock(text=_PAIR_BATCH_RESPONSE),
+        "single": Mock(text=_SINGLE_RESPONSE),
+        "cached": Mock(text="cached"),
+        "malformed": Mock(text="I can't help with that request.")
+    }
+
+
+@pytest.fixture(scope="module")
+def mapper_factory(mock_genai, llm_canned):
+    def create_mapper(*scenarios):
+        mapper = PaymentFlowMapper()
+        mapper.client = Mock()
+        if len(scenarios) == 1:
+            mapper.client.generate_content = Mock(return_value=[llm_canned[scenarios[0]]])
+        elif scenarios:
+            mapper.client.generate_content = Mock(side_effect=[[llm_canned[name]] for name in scenarios])
+        return mapper
+    return create_mapper
+
+
+@pytest.fixture(scope="module")
+def offline_mapper():
+    return PaymentFlowMapper.__new__(PaymentFlowMapper)
+
+
+@pytest.fixture(autouse=True)
+def reset_mapper(mapper, mock_genai):
+    mock_genai.reset_mock()
+    yield
+    mapper.clear_cache()
+    mapper.client.reset_mock()
+
+
 class TestPaymentFlowMapper:
     
     @pytest.mark.unit
@@ -31,27 +166,12 @@ class TestPaymentFlowMapper:
             mock_genai.GenerativeModel.assert_called_once_with('gemini-2.5-flash-lite')
     
     @pytest.mark.unit
-    def test_map_payment_flow(self, mapper):
+    def test_map_payment_flow(self, mapper_factory):
         code = """
         stripe.Customer.create(email='test@example.com')
         stripe.PaymentIntent.create(amount=1000)
         """
-        
-        mock_response = Mock()
-        mock_response.text = json.dumps({
-            "flow_description": "Customer creation and payment",
-            "steps": [
-                {"description": "Create customer", "code_reference": "line 1"},
-                {"description": "Create payment intent", "code_reference": "line 2"}
-            ],
-            "entities": ["customer", "payment_intent"],
-            "api_calls": ["stripe.Customer.create", "stripe.PaymentIntent.create"],
-            "business_logic": "Create customer then charge payment",
-            "validation_rules": ["Email validation", "Amount validation"],
-            "error_handling": ["Handle API errors"]
-        })
-        
-        mapper.client.generate_content = Mock(return_value=mock_response)
+        mapper = mapper_factory("payment_flow")
         
         flow_map = mapper.map_payment_flow(code, "stripe", "payment")
         
@@ -61,28 +181,161 @@ class TestPaymentFlowMapper:
         assert "stripe.Customer.create" in flow_map.api_calls
     
     @pytest.mark.unit
-    def test_parse_flow_response_with_json_block(self, mapper):
-        response = """
-        Here's the analysis:
-        ```json
-        {
-            "flow_description": "Test flow",
-            "steps": [],
-            "entities": [],
-            "api_calls": [],
-            "business_logic": "Test logic",
-            "validation_rules": [],
-            "error_handling": []
-        }
-        ```
-        """
+    def test_map_payment_flow_reuses_similar_code(self, mapper_factory):
+        mapper = mapper_factory("customer_creation")
+
+        code = "customer = stripe.Customer.create(email=email, name=name)\nreturn customer"
+        mapper.map_payment_flow(code, "stripe", "customer_creation", namespace="test/repo")
+        flow_map = mapper.map_payment_flow(code + "\n", "stripe", "customer_creation", namespace="test/repo")
+
+        assert flow_map.flow_description == "Customer creation"
+        assert mapper.client.generate_content.call_count == 1
+
+    @pytest.mark.unit
+    def test_map_payment_flow_cache_is_namespaced(self, mapper_factory):
+        mapper = mapper_factory("customer_creation")
+
+        code = "customer = stripe.Customer.create(email=email)"
+        mapper.map_payment_flow(code, "stripe", "customer_creation", namespace="owner/one")
+        mapper.map_payment_flow(code + "\n", "stripe", "customer_creation", namespace="owner/two")
+
+        assert mapper.client.generate_content.call_count == 2
+
+    @pytest.mark.unit
+    def test_map_payment_flow_does_not_cache_unparseable_reply(self, mapper_factory):
+        mapper = mapper_factory("malformed")
+
+        code = "customer = stripe.Customer.create(email=email)"
+        flow_map = mapper.map_payment_flow(code, "stripe", "customer_creation", namespace="test/repo")
+
+        assert "Error parsing flow" in flow_map.flow_description
+        assert mapper.semantic_cache.get("test/repo", "stripe", "customer_creation", code) is None
+
+    @pytest.mark.unit
+    def test_map_payment_flow_retries_after_unparseable_reply(self, mapper_factory):
+        mapper = mapper_factory("malformed", "customer_creation")
+
+        code = "customer = stripe.Customer.create(email=email)"
+        mapper.map_payment_flow(code, "stripe", "customer_creation")
+        flow_map = mapper.map_payment_flow(code, "stripe", "customer_creation")
+
+        assert flow_map.flow_description == "Customer creation"
+        assert mapper.client.generate_content.call_count == 2
+
+    @pytest.mark.unit
+    def test_map_payment_flows_batch_does_not_cache_malformed_batch(self, mapper_factory):
+        mapper = mapper_factory("short_batch", "single", "single", "pair_batch")
+        items = [
+            ("stripe.Customer.create(email=email)", "stripe", "customer_creation"),
+            ("stripe.Refund.create(charge=charge_id)", "stripe", "refund")
+        ]
+
+        mapper.map_payment_flows_batch(items, namespace="owner/one")
+        flow_maps = mapper.map_payment_flows_batch(items, namespace="owner/two")
+
+        assert [m.flow_description for m in flow_maps] == ["Customer creation", "Refund"]
+        assert mapper.client.generate_content.call_count == 4
+
+    @pytest.mark.unit
+    def test_get_llm_response_caches_identical_prompts(self, mapper_factory):
+        mapper = mapper_factory("cached")
+
+        assert mapper._get_llm_response("prompt") == "cached"
+        mapper._store_llm_response("prompt", "cached")
+        assert mapper._get_llm_response("prompt") == "cached"
+        mapper._get_llm_response("another prompt")
+
+        assert mapper.client.generate_content.call_count == 2
+
+    @pytest.mark.unit
+    def test_get_llm_response_stops_streaming_after_json_block(self, mapper_factory):
+        mapper = mapper_factory()
+        consumed = []
         
-        flow_map = mapper._parse_flow_response(response, "stripe")
+        def stream(prompt, stream):
+            for text in ['Here you go:\n```json\n{"flow_description": ', '"Streamed"}\n``', '`', '\nSome trailing notes']:
+                consumed.append(text)
+                yield Mock(text=text)
+        
+        mapper.client.generate_content = Mock(side_effect=stream)
+        
+        response = mapper._get_llm_response("prompt")
+        
+        assert len(consumed) == 3
+        assert mapper._parse_flow_response(response, "stripe").flow_description == "Streamed"
+        mapper.client.generate_content.assert_called_once_with("prompt", stream=True)
+    
+    @pytest.mark.unit
+    def test_get_llm_response_keeps_streaming_past_quoted_snippet(self, mapper_factory):
+        mapper = mapper_factory()
+        split = _QUOTED_SNIPPET_RESPONSE.index("Analysis:")
+        chunks = [_QUOTED_SNIPPET_RESPONSE[:split], _QUOTED_SNIPPET_RESPONSE[split:]]
+        mapper.client.generate_content = Mock(return_value=[Mock(text=text) for text in chunks])
+        
+        response = mapper._get_llm_response("prompt")
+        
+        assert response == _QUOTED_SNIPPET_RESPONSE
+        assert mapper._parse_flow_response(response, "stripe").flow_description == "Real"
+    
+    @pytest.mark.unit
+    def test_map_payment_flows_batch_uses_single_call(self, mapper_factory):
+        mapper = mapper_factory("batch")
+        
+        flow_maps = mapper.map_payment_flows_batch([
+            ("stripe.Customer.create(email=email)", "stripe", "customer_creation"),
+            ("stripe.Refund.create(charge=charge_id)", "stripe", "refund"),
+            ("square.subscriptions_api.create_subscription(body)", "square", "subscription")
+        ])
+        
+        assert [m.flow_description for m in flow_maps] == ["Customer creation", "Refund", "Subscription"]
+        assert flow_maps[2].original_provider == "square"
+        assert mapper.client.generate_content.call_count == 1
+        prompt = mapper.client.generate_content.call_args[0][0]
+        assert "### Flow 3" in prompt
+    
+    @pytest.mark.unit
+    def test_map_payment_flows_batch_falls_back_on_malformed_response(self, mapper_factory):
+        mapper = mapper_factory("short_batch", "single", "single")
+        
+        flow_maps = mapper.map_payment_flows_batch([
+            ("stripe.Customer.create(email=email)", "stripe", "customer_creation"),
+            ("stripe.Refund.create(charge=charge_id)", "stripe", "refund")
+        ])
+        
+        assert [m.flow_description for m in flow_maps] == ["Single", "Single"]
+        assert mapper.client.generate_content.call_count == 3
+    
+    @pytest.mark.unit
+    def test_parse_flow_response_with_json_block(self, mapper):
+        flow_map = mapper._parse_flow_response(_JSON_BLOCK_RESPONSE, "stripe")
         
         assert flow_map.flow_description == "Test flow"
         assert flow_map.business_logic == "Test logic"
         assert flow_map.original_provider == "stripe"
     
+    @pytest.mark.unit
+    def test_parse_flow_response_with_nested_json_and_unlabelled_fence(self, mapper):
+        flow_map = mapper._parse_flow_response(_UNLABELLED_FENCE_RESPONSE, "stripe")
+        
+        assert flow_map.flow_description == "Nested"
+        assert flow_map.steps == [{"description": "Charge"}]
+    
+    @pytest.mark.unit
+    @pytest.mark.parametrize("response", [
+        pytest.param('```json\n{"flow_description": "Truncated", "steps": []}\n', id="json"),
+        pytest.param('```\n{"flow_description": "Truncated", "steps": []}', id="unlabelled")
+    ])
+    def test_parse_flow_response_with_unterminated_fence(self, mapper, response):
+        flow_map = mapper._parse_flow_response(response, "stripe")
+        
+        assert flow_map.flow_description == "Truncated"
+    
+    @pytest.mark.unit
+    def test_parse_flow_response_prefers_json_block_over_quoted_snippet(self, mapper):
+        flow_map = mapper._parse_flow_response(_QUOTED_SNIPPET_RESPONSE, "stripe")
+        
+        assert flow_map.flow_description == "Real"
+    
     @pytest.mark.unit
     def test_parse_flow_response_error_handling(self, mapper):
         response = "Invalid JSON response"
@@ -94,45 +347,15 @@ class TestPaymentFlowMapper:
         assert len(flow_map.steps) == 0
     
     @pytest.mark.unit
-    def test_generate_documentation(self, mapper):
-        flow_map = PaymentFlowMap(
-            original_provider="stripe",
-            flow_description="Payment processing flow",
-            steps=[
-                {"description": "Validate input"},
-                {"description": "Process payment", "code_reference": "payment.py:25"}
-            ],
-            entities=["customer", "payment"],
-            api_calls=["stripe.PaymentIntent.create"],
-            business_logic="Process customer payment",
-            validation_rules=["Amount > 0", "Valid card"],
-            error_handling=["Retry on timeout", "Log failures"]
-        )
+    def test_generate_documentation(self, offline_mapper):
+        doc = offline_mapper.generate_documentation(_DOCUMENTATION_MAP)
         
-        doc = mapper.generate_documentation(flow_map)
-        
-        assert "# Payment Flow Documentation" in doc
-        assert "stripe" in doc
-        assert "Validate input" in doc
-        assert "customer, payment" in doc
-        assert "stripe.PaymentIntent.create" in doc
-        assert "Amount > 0" in doc
-        assert "Retry on timeout" in doc
-    
-    @pytest.mark.unit
-    def test_compare_with_flowglad_stripe(self, mapper):
-        flow_map = PaymentFlowMap(
-            original_provider="stripe",
-            flow_description="",
-            steps=[],
-            entities=["customer"],
-            api_calls=["stripe.Customer.create", "stripe.PaymentIntent.create"],
-            business_logic="",
-            validation_rules=["Email validation"],
-            error_handling=[]
-        )
-        
-        comparison = mapper.compare_with_flowglad(flow_map)
+        missing = [expected for expected in _DOCUMENTATION_EXPECTED if expected not in doc]
+        assert not missing, missing
+    
+    @pytest.mark.unit
+    def test_compare_with_flowglad_stripe(self, offline_mapper):
+        comparison = offline_mapper.compare_with_flowglad(_STRIPE_COMPARE_MAP)
         
         assert comparison["provider"] == "stripe"
         assert len(comparison["flowglad_equivalents"]) > 0
@@ -142,105 +365,43 @@ class TestPaymentFlowMapper:
         assert len(comparison["required_changes"]) > 0
     
     @pytest.mark.unit
-    def test_compare_with_flowglad_square(self, mapper):
-        flow_map = PaymentFlowMap(
-            original_provider="square",
-            flow_description="",
-            steps=[],
-            entities=["payment"],
-            api_calls=["square.payments_api.create_payment"],
-            business_logic="",
-            validation_rules=[],
-            error_handling=[]
-        )
-        
-        comparison = mapper.compare_with_flowglad(flow_map)
+    def test_compare_with_flowglad_square(self, offline_mapper):
+        comparison = offline_mapper.compare_with_flowglad(_SQUARE_COMPARE_MAP)
         
         assert comparison["provider"] == "square"
         assert any(eq["flowglad"] == "flowglad.payments.create" 
                   for eq in comparison["flowglad_equivalents"])
     
     @pytest.mark.unit
-    def test_assess_complexity_low(self, mapper):
-        flow_map = PaymentFlowMap(
-            original_provider="stripe",
-            flow_description="",
-            steps=[{"step": 1}],
-            entities=["customer"],
-            api_calls=[],
-            business_logic="",
-            validation_rules=["rule1"],
-            error_handling=[]
+    @pytest.mark.parametrize("num_steps,entities,num_rules,expected", [
+        (1, ["customer"], 1, "Low"),
+        (5, ["customer", "payment", "subscription"], 3, "Medium"),
+        (15, ["customer", "payment", "subscription", "invoice", "refund"], 10, "High")
+    ])
+    def test_assess_complexity(self, offline_mapper, num_steps, entities, num_rules, expected):
+        flow_map = replace(
+            _BASE_FLOW_MAP,
+            steps=[{"step": i} for i in range(num_steps)],
+            entities=entities,
+            validation_rules=[f"rule{i}" for i in range(num_rules)]
         )
         
-        complexity = mapper._assess_complexity(flow_map)
-        assert complexity == "Low"
+        assert offline_mapper._assess_complexity(flow_map) == expected
     
     @pytest.mark.unit
-    def test_assess_complexity_medium(self, mapper):
-        flow_map = PaymentFlowMap(
-            original_provider="stripe",
-            flow_description="",
-            steps=[{"step": i} for i in range(5)],
-            entities=["customer", "payment", "subscription"],
-            api_calls=[],
-            business_logic="",
-            validation_rules=["rule1", "rule2", "rule3"],
-            error_handling=[]
-        )
-        
-        complexity = mapper._assess_complexity(flow_map)
-        assert complexity == "Medium"
-    
-    @pytest.mark.unit
-    def test_assess_complexity_high(self, mapper):
-        flow_map = PaymentFlowMap(
-            original_provider="stripe",
-            flow_description="",
-            steps=[{"step": i} for i in range(15)],
-            entities=["customer", "payment", "subscription", "invoice", "refund"],
-            api_calls=[],
-            business_logic="",
-            validation_rules=["rule" + str(i) for i in range(10)],
-            error_handling=[]
-        )
-        
-        complexity = mapper._assess_complexity(flow_map)
-        assert complexity == "High"
-    
-    @pytest.mark.unit
-    def test_identify_required_changes_webhooks(self, mapper):
-        flow_map = PaymentFlowMap(
-            original_provider="stripe",
-            flow_description="",
-            steps=[],
-            entities=["customer"],
-            api_calls=["stripe.Webhook.construct_event"],
-            business_logic="",
-            validation_rules=["Email validation"],
-            error_handling=[]
-        )
-        
-        changes = mapper._identify_required_changes(flow_map)
-        
-        assert "Update webhook endpoints to FlowGlad format" in changes
-        assert "Convert customer data model to FlowGlad schema" in changes
-        assert "Adapt validation rules to FlowGlad requirements" in changes
-        assert "Update API authentication to use FlowGlad keys" in changes
-    
-    @pytest.mark.unit
-    def test_identify_required_changes_subscriptions(self, mapper):
-        flow_map = PaymentFlowMap(
-            original_provider="stripe",
-            flow_description="",
-            steps=[],
-            entities=[],
-            api_calls=["stripe.Subscription.create"],
-            business_logic="",
-            validation_rules=[],
-            error_handling=[]
-        )
-        
-        changes = mapper._identify_required_changes(flow_map)
+    @pytest.mark.parametrize("api_calls,entities,validation_rules,expected", [
+        (["stripe.Webhook.construct_event"], ["customer"], ["Email validation"], {
+            "Update webhook endpoints to FlowGlad format",
+            "Convert customer data model to FlowGlad schema",
+            "Adapt validation rules to FlowGlad requirements",
+            "Update API authentication to use FlowGlad keys"
+        }),
+        (["stripe.Subscription.create"], [], [], {
+            "Migrate subscription models to FlowGlad subscription API"
+        })
+    ], ids=["webhooks", "subscriptions"])
+    def test_identify_required_changes(self, offline_mapper, api_calls, entities, validation_rules, expected):
+        flow_map = replace(_BASE_FLOW_MAP, api_calls=api_calls, entities=entities, validation_rules=validation_rules)
         
-        assert "Migrate subscription models to FlowGlad subscription API" in changes
\ No newline at end of file
+        missing = expected.difference(offline_mapper._identify_required_changes(flow_map))
+        assert not missing, missing
\ No newline at end of file
@@ -1,84 +1,62 @@
 import pytest
+import ast
+import io
 from unittest.mock import Mock, patch
-import sys
-import os
-sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from flowglad_converter import FlowGladConverter, CodeTransformation, ConversionRule
+from flowglad_converter import FlowGladConverter, CodeTransformation, ConversionRule, detect_provider
 
 
-@pytest.fixture
-def converter():
-    return FlowGladConverter()
-
+_MIGRATION_TRANSFORMATIONS = (
+    CodeTransformation(
+        original_code="import stripe",
+        transformed_code="import flowglad",
+        file_path="payment.py",
+        line_range=(1, 1),
+        transformation_type="import"
+    ),
+    CodeTransformation(
+        original_code="stripe.Customer.create",
+        transformed_code="flowglad.customers.create",
+        file_path="customer.py",
+        line_range=(10, 10),
+        transformation_type="api_call"
+    )
+)
+_MIGRATION_SCRIPT_EXPECTED = (
+    "#!/usr/bin/env python3",
+    "FlowGlad Migration Script",
+    "backup_files",
+    "apply_transformations",
+    "update_env_file",
+    "payment.py",
+    "customer.py",
+    "import flowglad"
+)
 
-class TestFlowGladConverter:
-    
-    @pytest.mark.unit
-    def test_initialization(self, converter):
-        assert len(converter.conversion_rules) > 0
-        
-        stripe_rules = [r for r in converter.conversion_rules if r.provider == "stripe"]
-        square_rules = [r for r in converter.conversion_rules if r.provider == "square"]
-        
-        assert len(stripe_rules) > 0
-        assert len(square_rules) > 0
-    
-    @pytest.mark.unit
-    def test_convert_stripe_python_imports(self, converter):
-        code = """import stripe
+_STRIPE_IMPORTS_CODE = """import stripe
 
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')"""
-        
-        transformation = converter.convert_code(code, "stripe", "python")
-        
-        assert "import flowglad" in transformation.transformed_code
-        assert "FLOWGLAD_SECRET_KEY" in transformation.transformed_code
-        assert transformation.transformation_type == "full_conversion"
-    
-    @pytest.mark.unit
-    def test_convert_stripe_customer_creation(self, converter):
-        code = """
+
+_STRIPE_CUSTOMER_CODE = """
 customer = stripe.Customer.create(
     email='test@example.com',
     name='Test User'
 )"""
-        
-        transformation = converter.convert_code(code, "stripe", "python")
-        
-        assert "flowglad.customers.create" in transformation.transformed_code
-        assert "email=" in transformation.transformed_code
-    
-    @pytest.mark.unit
-    def test_convert_stripe_payment_intent(self, converter):
-        code = """
+
+_STRIPE_PAYMENT_INTENT_CODE = """
 payment_intent = stripe.PaymentIntent.create(
     amount=2000,
     currency='usd',
     automatic_payment_methods={'enabled': True}
 )"""
-        
-        transformation = converter.convert_code(code, "stripe", "python")
-        
-        assert "flowglad.checkout.sessions.create" in transformation.transformed_code
-        assert "amount=" in transformation.transformed_code
-    
-    @pytest.mark.unit
-    def test_convert_stripe_subscription(self, converter):
-        code = """
+
+_STRIPE_SUBSCRIPTION_CODE = """
 subscription = stripe.Subscription.create(
     customer='cus_123',
     items=[{'price': 'price_123'}]
 )"""
-        
-        transformation = converter.convert_code(code, "stripe", "python")
-        
-        assert "flowglad.subscriptions.create" in transformation.transformed_code
-        assert "customer_id=" in transformation.transformed_code
-    
-    @pytest.mark.unit
-    def test_convert_square_python(self, converter):
-        code = """
+
+_SQUARE_PYTHON_CODE = """
 from square.client import Client
 
 client = Client(access_token=os.getenv('SQUARE_ACCESS_TOKEN'))
@@ -87,17 +65,8 @@ result = client.payments_api.create_payment(body={
     'source_id': 'cnon:card',
     'amount_money': {'amount': 100, 'currency': 'USD'}
 })"""
-        
-        transformation = converter.convert_code(code, "square", "python")
-        
-        assert "from flowglad import FlowGlad" in transformation.transformed_code
-        assert "FlowGlad(" in transformation.transformed_code
-        assert ".payments.create" in transformation.transformed_code
-        assert "FLOWGLAD_SECRET_KEY" in transformation.transformed_code
-    
-    @pytest.mark.unit
-    def test_convert_javascript_stripe(self, converter):
-        js_code = """
+
+_JS_STRIPE_CODE = """
 const stripe = require('stripe')('sk_test_123');
 
 const customer = await stripe.customers.create({
@@ -108,17 +77,8 @@ const paymentIntent = await stripe.paymentIntents.create({
     amount: 1000,
     currency: 'usd'
 });"""
-        
-        transformation = converter.convert_code(js_code, "stripe", "javascript")
-        
-        assert "flowglad" in transformation.transformed_code
-        assert "flowglad.customers.create" in transformation.transformed_code
-        assert "flowglad.checkout.sessions.create" in transformation.transformed_code
-        assert "FLOWGLAD_SECRET_KEY" in transformation.transformed_code
-    
-    @pytest.mark.unit
-    def test_convert_typescript_stripe(self, converter):
-        ts_code = """
+
+_TS_STRIPE_CODE = """
 import Stripe from 'stripe';
 
 const stripe = new Stripe(process.env.STRIPE_SECRET_KEY);
@@ -127,60 +87,178 @@ const subscription = await stripe.subscriptions.create({
     customer: customerId,
     items: [{price: priceId}]
 });"""
+
+_STRIPE_WEBHOOK_CODE = """
+event = stripe.Webhook.construct_event(
+    payload, sig_header, webhook_secret
+)"""
+
+_STRIPE_REFUND_CODE = """
+refund = stripe.Refund.create(
+    payment_intent='pi_123',
+    reason='requested_by_customer'
+)"""
+
+_STRIPE_CHECKOUT_CODE = """
+session = stripe.checkout.Session.create(
+    payment_method_types=['card'],
+    line_items=[{
+        'price': 'price_123',
+        'quantity': 1
+    }],
+    mode='payment',
+    success_url='https://example.com/success',
+    cancel_url='https://example.com/cancel'
+)"""
+
+_GENERIC_STRIPE_CODE = "stripe.Customer.create(email='test@example.com')"
+
+_NO_PROVIDER_CODE = """import os
+
+def total(amount=0, customer=None):
+    return amount"""
+
+_PLAIN_FUNCTION_CODE = """
+def process_payment():
+    pass"""
+
+_STRIPE_PARAMS_CODE = """
+payment = create_payment(
+    amount=1000,
+    currency='usd',
+    customer='cus_123',
+    payment_method='pm_123',
+    description='Test payment'
+)"""
+
+_SQUARE_PARAMS_CODE = """
+payment = create_payment(
+    amount_money={'amount': 100},
+    source_id='card_123',
+    customer_id='cus_123'
+)"""
+
+_KEYWORD_LOOKALIKES_CODE = """# pass customer= explicitly
+def charge(customer=None):
+    label = "customer=guest"
+    return create_payment(customer = customer, **extra)  # keep formatting"""
+
+
+@pytest.fixture(scope="module")
+def converter():
+    return FlowGladConverter()
+
+
+class TestFlowGladConverter:
+    
+    @pytest.mark.unit
+    def test_initialization(self, converter):
+        assert len(converter.conversion_rules) > 0
+        
+        stripe_rules = [r for r in converter.conversion_rules if r.provider == "stripe"]
+        square_rules = [r for r in converter.conversion_rules if r.provider == "square"]
         
-        transformation = converter.convert_code(ts_code, "stripe", "typescript")
+        assert len(stripe_rules) > 0
+        assert len(square_rules) > 0
+    
+    @pytest.mark.unit
+    def test_rules_indexed_by_provider(self, converter):
+        stripe_rules = [r for r in converter.conversion_rules if r.provider == "stripe"]
+        square_rules = [r for r in converter.conversion_rules if r.provider == "square"]
         
-        assert "FlowGlad" in transformation.transformed_code
-        assert "flowglad.subscriptions.create" in transformation.transformed_code
-        assert "FLOWGLAD_SECRET_KEY" in transformation.transformed_code
+        assert converter._rules_by_provider["stripe"] == stripe_rules
+        assert converter._rules_by_provider["square"] == square_rules
+        assert converter._rules_by_provider.keys() == converter._rule_sets.keys()
     
     @pytest.mark.unit
-    def test_convert_webhook_handling(self, converter):
-        code = """
-event = stripe.Webhook.construct_event(
-    payload, sig_header, webhook_secret
-)"""
+    @pytest.mark.parametrize("code,provider,file_type,expected_substrings,expected_type", [
+        pytest.param(_STRIPE_IMPORTS_CODE, "stripe", "python", ("import flowglad", "FLOWGLAD_SECRET_KEY"), "full_conversion", id="stripe_python_imports"),
+        pytest.param(_STRIPE_CUSTOMER_CODE, "stripe", "python", ("flowglad.customers.create", "email="), "full_conversion", id="stripe_customer_creation"),
+        pytest.param(_STRIPE_PAYMENT_INTENT_CODE, "stripe", "python", ("flowglad.checkout.sessions.create", "amount="), "full_conversion", id="stripe_payment_intent"),
+        pytest.param(_STRIPE_SUBSCRIPTION_CODE, "stripe", "python", ("flowglad.subscriptions.create", "customer_id="), "full_conversion", id="stripe_subscription"),
+        pytest.param(_SQUARE_PYTHON_CODE, "square", "python", ("from flowglad import FlowGlad", "FlowGlad(", ".payments.create", "FLOWGLAD_SECRET_KEY"), "full_conversion", id="square_python"),
+        pytest.param(_JS_STRIPE_CODE, "stripe", "javascript", ("flowglad", "flowglad.customers.create", "flowglad.checkout.sessions.create", "FLOWGLAD_SECRET_KEY"), "full_conversion", id="javascript_stripe"),
+        pytest.param(_TS_STRIPE_CODE, "stripe", "typescript", ("FlowGlad", "flowglad.subscriptions.create", "FLOWGLAD_SECRET_KEY"), "full_conversion", id="typescript_stripe"),
+        pytest.param(_STRIPE_WEBHOOK_CODE, "stripe", "python", ("flowglad.webhooks.verify",), "full_conversion", id="webhook_handling"),
+        pytest.param(_STRIPE_REFUND_CODE, "stripe", "python", ("flowglad.refunds.create",), "full_conversion", id="refund_creation"),
+        pytest.param(_STRIPE_CHECKOUT_CODE, "stripe", "python", ("flowglad.checkout.sessions.create", "success_url=", "cancel_url="), "full_conversion", id="checkout_session"),
+        pytest.param(_GENERIC_STRIPE_CODE, "stripe", "generic", ("flowglad.customers.create",), "generic_conversion", id="generic_file_type")
+    ])
+    def test_convert_code(self, converter, code, provider, file_type, expected_substrings, expected_type):
+        transformation = converter.convert_code(code, provider, file_type)
+        
+        missing = [expected for expected in expected_substrings if expected not in transformation.transformed_code]
+        assert not missing, missing
+        assert transformation.transformation_type == expected_type
+    
+    @pytest.mark.unit
+    def test_convert_rewrites_inside_client_arguments(self, converter):
+        code = "client = stripe.Stripe(os.getenv('STRIPE_SECRET_KEY'))"
         
-        transformation = converter.convert_code(code, "stripe", "python")
+        transformation = converter.convert_code(code, "stripe", "generic")
         
-        assert "flowglad.webhooks.verify" in transformation.transformed_code
+        assert transformation.transformed_code == "client = flowglad.FlowGlad(os.getenv('FLOWGLAD_SECRET_KEY'))"
     
     @pytest.mark.unit
-    def test_convert_refund_creation(self, converter):
-        code = """
-refund = stripe.Refund.create(
-    payment_intent='pi_123',
-    reason='requested_by_customer'
-)"""
+    def test_literal_rules_use_plain_replacement(self, converter):
+        stripe_rules = converter._rule_sets["stripe"]
         
-        transformation = converter.convert_code(code, "stripe", "python")
+        assert ("import stripe", "import flowglad") in stripe_rules.literals
+        assert ("stripe.Customer.create", "flowglad.customers.create") in stripe_rules.literals
+        assert stripe_rules.pattern.pattern == r"(?P<r0>stripe\.Stripe\((.*?)\))"
+    
+    @pytest.mark.unit
+    def test_convert_skips_files_without_provider_references(self, converter):
+        transformation = converter.convert_code(_NO_PROVIDER_CODE, "stripe", "python")
         
-        assert "flowglad.refunds.create" in transformation.transformed_code
+        assert transformation.transformation_type == "noop"
+        assert transformation.transformed_code == _NO_PROVIDER_CODE
     
     @pytest.mark.unit
-    def test_add_flowglad_imports(self, converter):
-        code = """
-def process_payment():
-    pass"""
+    def test_detect_provider(self):
+        assert detect_provider("import stripe\nstripe.Customer.create()") == "stripe"
+        assert detect_provider("const stripe = new Stripe(key);") == "stripe"
+        assert detect_provider("from square.client import Client") == "square"
+        assert detect_provider("result = client.paymentsApi.createPayment(body);") == "square"
+        assert detect_provider("client = httpx.Client(timeout=5)") is None
+    
+    @pytest.mark.unit
+    def test_convert_code_detects_provider(self, converter):
+        code = "result = client.payments_api.create_payment(body=body)"
         
-        result = converter._add_flowglad_imports(code)
+        transformation = converter.convert_code(code, file_type="generic")
+        
+        assert transformation.transformed_code == "result = client.payments.create(body=body)"
+        assert converter.convert_code("total = 1").transformation_type == "noop"
+    
+    @pytest.mark.unit
+    def test_convert_square_api_calls_without_import(self, converter):
+        code = "result = client.payments_api.create_payment(body=body)"
+        
+        transformation = converter.convert_code(code, "square", "generic")
+        
+        assert transformation.transformed_code == "result = client.payments.create(body=body)"
+    
+    @pytest.mark.unit
+    def test_add_flowglad_imports(self, converter):
+        result = converter._add_flowglad_imports(_PLAIN_FUNCTION_CODE)
         
         assert "import flowglad" in result
         assert "from dotenv import load_dotenv" in result
         assert "load_dotenv()" in result
     
     @pytest.mark.unit
-    def test_update_python_params_stripe(self, converter):
-        code = """
-payment = create_payment(
-    amount=1000,
-    currency='usd',
-    customer='cus_123',
-    payment_method='pm_123',
-    description='Test payment'
-)"""
+    def test_add_flowglad_imports_before_first_import(self, converter):
+        code = "#!/usr/bin/env python\nimport os\nfrom json import dumps"
+        
+        result = converter._add_flowglad_imports(code)
         
-        result = converter._update_python_params(code, "stripe")
+        assert result == "#!/usr/bin/env python\nimport flowglad\nfrom dotenv import load_dotenv\nload_dotenv()\n\nimport os\nfrom json import dumps"
+        assert converter._add_flowglad_imports(result) == result
+    
+    @pytest.mark.unit
+    def test_update_python_params_stripe(self, converter):
+        result = converter._update_python_params(_STRIPE_PARAMS_CODE, "stripe")
         
         assert "amount=" in result
         assert "customer_id=" in result
@@ -189,74 +267,64 @@ payment = create_payment(
     
     @pytest.mark.unit
     def test_update_python_params_square(self, converter):
-        code = """
-payment = create_payment(
-    amount_money={'amount': 100},
-    source_id='card_123',
-    customer_id='cus_123'
-)"""
-        
-        result = converter._update_python_params(code, "square")
+        result = converter._update_python_params(_SQUARE_PARAMS_CODE, "square")
         
         assert "amount=" in result
         assert "payment_source=" in result
         assert "customer_id=" in result
     
+    @pytest.mark.unit
+    def test_update_python_params_only_renames_call_keywords(self, converter):
+        result = converter._update_python_params(_KEYWORD_LOOKALIKES_CODE, "stripe")
+        
+        assert result == _KEYWORD_LOOKALIKES_CODE.replace("create_payment(customer =", "create_payment(customer_id =")
+    
+    @pytest.mark.unit
+    def test_update_python_params_falls_back_on_partial_snippets(self, converter):
+        result = converter._update_python_params("create_payment(customer='cus_123',", "stripe")
+        
+        assert result == "create_payment(customer_id='cus_123',"
+    
     @pytest.mark.unit
     def test_generate_migration_script(self, converter):
+        script = converter.generate_migration_script(_MIGRATION_TRANSFORMATIONS)
+        
+        missing = [expected for expected in _MIGRATION_SCRIPT_EXPECTED if expected not in script]
+        assert not missing, missing
+    
+    @pytest.mark.unit
+    def test_generate_migration_script_escapes_code_and_streams(self, converter):
         transformations = [
             CodeTransformation(
-                original_code="import stripe",
-                transformed_code="import flowglad",
+                original_code="",
+                transformed_code="doc = \'\'\'quoted\'\'\'\nimport flowglad",
                 file_path="payment.py",
-                line_range=(1, 1),
-                transformation_type="import"
-            ),
-            CodeTransformation(
-                original_code="stripe.Customer.create",
-                transformed_code="flowglad.customers.create",
-                file_path="customer.py",
-                line_range=(10, 10),
-                transformation_type="api_call"
+                line_range=(1, 2),
+                transformation_type="full_conversion"
             )
         ]
+        out = io.StringIO()
         
-        script = converter.generate_migration_script(transformations)
+        assert converter.generate_migration_script(transformations, out=out) is None
         
-        assert "#!/usr/bin/env python3" in script
-        assert "FlowGlad Migration Script" in script
-        assert "backup_files" in script
-        assert "apply_transformations" in script
-        assert "update_env_file" in script
-        assert "payment.py" in script
-        assert "customer.py" in script
-        assert "import flowglad" in script
+        script = out.getvalue()
+        ast.parse(script)
+        assert script == converter.generate_migration_script(transformations)
+        assert repr(transformations[0].transformed_code) in script
     
     @pytest.mark.unit
-    def test_convert_checkout_session(self, converter):
-        code = """
-session = stripe.checkout.Session.create(
-    payment_method_types=['card'],
-    line_items=[{
-        'price': 'price_123',
-        'quantity': 1
-    }],
-    mode='payment',
-    success_url='https://example.com/success',
-    cancel_url='https://example.com/cancel'
-)"""
+    def test_migration_script_updates_env_in_one_pass(self, converter, tmp_path, monkeypatch):
+        namespace = {}
+        exec(converter.generate_migration_script([]), namespace)
+        env_file = tmp_path / ".env"
+        env_file.write_text("STRIPE_SECRET_KEY=sk\nSQUARE_ACCESS_TOKEN=sq\nOTHER=1\n")
+        monkeypatch.chdir(tmp_path)
         
-        transformation = converter.convert_code(code, "stripe", "python")
+        namespace["update_env_file"]()
         
-        assert "flowglad.checkout.sessions.create" in transformation.transformed_code
-        assert "success_url=" in transformation.transformed_code
-        assert "cancel_url=" in transformation.transformed_code
-    
-    @pytest.mark.unit
-    def test_convert_generic_file_type(self, converter):
-        code = "stripe.Customer.create(email='test@example.com')"
+        assert env_file.read_text() == "FLOWGLAD_SECRET_KEY=sk\nFLOWGLAD_SECRET_KEY=sq\nOTHER=1\n"
         
-        transformation = converter.convert_code(code, "stripe", "generic")
+        with patch("builtins.open", wraps=open) as wrapped_open:
+            namespace["update_env_file"]()
         
-        assert "flowglad.customers.create" in transformation.transformed_code
-        assert transformation.transformation_type == "generic_conversion"
\ No newline at end of file
+        assert [c.args[1] for c in wrapped_open.call_args_list] == ["r"]
\ No newline at end of file
@@ -1,11 +1,16 @@
 import pytest
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
 from unittest.mock import Mock, patch, AsyncMock, MagicMock
-import sys
-import os
-sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+import httpx
 
 from mcp_connector import GitHubMCPConnector, MCPConfig
-from github import Repository
+from github import GithubException
+
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
 
 
 @pytest.fixture
@@ -22,9 +27,30 @@ def mock_github():
         yield mock
 
 
+@pytest.fixture(scope="module")
+def mock_http():
+    http = SimpleNamespace(routes={}, requests=[])
+    
+    def handler(request):
+        http.requests.append(request)
+        return httpx.Response(200, json=http.routes[request.method, request.url.path])
+    
+    http.transport = httpx.MockTransport(handler)
+    return http
+
+
+@pytest.fixture
+def connector(mock_config, mock_github, mock_http):
+    mock_http.routes.clear()
+    mock_http.requests.clear()
+    return GitHubMCPConnector(mock_config, client=httpx.AsyncClient(transport=mock_http.transport))
+
+
 @pytest.fixture
-def connector(mock_config, mock_github):
-    return GitHubMCPConnector(mock_config)
+def mock_repo():
+    repo = MagicMock()
+    repo.full_name = "owner/repo"
+    return repo
 
 
 class TestGitHubMCPConnector:
@@ -50,25 +76,19 @@ class TestGitHubMCPConnector:
         assert connector._authenticated is False
     
     @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_connect_to_mcp(self, connector):
-        with patch.object(connector.client, 'post', new_callable=AsyncMock) as mock_post:
-            mock_response = Mock()
-            mock_response.raise_for_status = Mock()
-            mock_response.json.return_value = {"status": "connected"}
-            mock_post.return_value = mock_response
-            
-            result = await connector.connect_to_mcp()
-            
-            assert result == {"status": "connected"}
-            mock_post.assert_called_once_with(
-                "http://localhost:3000/connect",
-                json={"provider": "github", "token": "test_token_123"}
-            )
-    
-    @pytest.mark.unit
-    async def test_get_repository(self, connector, mock_github):
-        mock_repo = Mock(spec=Repository)
+    async def test_connect_to_mcp(self, connector, mock_http):
+        mock_http.routes["POST", "/connect"] = {"status": "connected"}
+        
+        result = await connector.connect_to_mcp()
+        
+        assert result == {"status": "connected"}
+        request, = mock_http.requests
+        assert request.method == "POST"
+        assert str(request.url) == "http://localhost:3000/connect"
+        assert json.loads(request.content) == {"provider": "github", "token": "test_token_123"}
+    
+    @pytest.mark.unit
+    async def test_get_repository(self, connector, mock_github, mock_repo):
         mock_github.return_value.get_repo.return_value = mock_repo
         
         result = await connector.get_repository("owner/repo")
@@ -76,45 +96,66 @@ class TestGitHubMCPConnector:
         assert result == mock_repo
         mock_github.return_value.get_repo.assert_called_once_with("owner/repo")
     
+    @pytest.mark.unit
+    async def test_get_repository_runs_off_event_loop(self, connector, mock_github):
+        caller_threads = []
+        mock_github.return_value.get_repo.side_effect = lambda name: caller_threads.append(threading.current_thread())
+        
+        await connector.get_repository("owner/repo")
+        
+        assert caller_threads and caller_threads[0] is not threading.main_thread()
+    
     @pytest.mark.unit
     async def test_list_repository_files(self, connector):
-        mock_repo = Mock(spec=Repository)
-        
-        mock_file1 = Mock()
-        mock_file1.type = "file"
-        mock_file1.path = "src/payment.py"
-        mock_file1.name = "payment.py"
-        mock_file1.size = 1024
-        mock_file1.sha = "abc123"
-        
-        mock_dir = Mock()
-        mock_dir.type = "dir"
-        mock_dir.path = "tests"
-        
-        mock_file2 = Mock()
-        mock_file2.type = "file"
-        mock_file2.path = "tests/test_payment.py"
-        mock_file2.name = "test_payment.py"
-        mock_file2.size = 512
-        mock_file2.sha = "def456"
-        
-        mock_repo.get_contents.side_effect = [
-            [mock_file1, mock_dir],
-            [mock_file2]
-        ]
+        mock_repo = Mock()
+        mock_repo.default_branch = "main"
+        
+        mock_repo.get_git_tree.return_value = SimpleNamespace(
+            raw_data={"truncated": False},
+            tree=[
+                SimpleNamespace(type="blob", path="src/payment.py", size=1024, sha="abc123"),
+                SimpleNamespace(type="tree", path="tests", size=None, sha="dir123"),
+                SimpleNamespace(type="blob", path="tests/test_payment.py", size=512, sha="def456")
+            ]
+        )
         
         files = await connector.list_repository_files(mock_repo)
         
+        mock_repo.get_git_tree.assert_called_once_with(sha="main", recursive=True)
         assert len(files) == 2
         assert files[0]["path"] == "src/payment.py"
+        assert files[0]["name"] == "payment.py"
         assert files[1]["path"] == "tests/test_payment.py"
+        
+        files = await connector.list_repository_files(mock_repo, "tests")
+        assert [f["path"] for f in files] == ["tests/test_payment.py"]
+    
+    @pytest.mark.unit
+    async def test_list_repository_files_walks_truncated_tree(self, connector, mock_repo):
+        mock_repo.default_branch = "main"
+        mock_repo.get_git_tree.return_value.raw_data = {"truncated": True}
+        
+        listings = {
+            "": [
+                {"type": "file", "path": "src/payment.py", "name": "payment.py", "size": 1024, "sha": "abc123"},
+                {"type": "dir", "path": "tests", "name": "tests", "size": 0, "sha": "dir123"}
+            ],
+            "tests": [
+                {"type": "file", "path": "tests/test_payment.py", "name": "test_payment.py", "size": 512, "sha": "def456"}
+            ]
+        }
+        
+        async def list_directory(repo, path):
+            return listings[path]
+        
+        with patch.object(connector, '_list_directory', side_effect=list_directory):
+            files = await connector.list_repository_files(mock_repo)
+        
+        assert [f["path"] for f in files] == ["src/payment.py", "tests/test_payment.py"]
     
     @pytest.mark.unit
-    async def test_get_file_content(self, connector):
-        mock_repo = Mock(spec=Repository)
-        mock_file = Mock()
-        mock_file.decoded_content = b"import stripe\nstripe.api_key = 'sk_test'"
-        mock_repo.get_contents.return_value = mock_file
+    async def test_get_file_content(self, connector, mock_repo):
+        mock_repo.get_contents.return_value = SimpleNamespace(decoded_content=b"import stripe\nstripe.api_key = 'sk_test'")
         
         content = await connector.get_file_content(mock_repo, "payment.py")
         
@@ -122,23 +163,12 @@ class TestGitHubMCPConnector:
         mock_repo.get_contents.assert_called_once_with("payment.py")
     
     @pytest.mark.unit
-    async def test_search_payment_files(self, connector, mock_github):
-        mock_result1 = Mock()
-        mock_result1.path = "src/stripe_payment.py"
-        mock_result1.repository.full_name = "owner/repo"
-        mock_result1.sha = "abc123"
-        mock_result1.score = 1.0
-        
-        mock_result2 = Mock()
-        mock_result2.path = "lib/square_checkout.js"
-        mock_result2.repository.full_name = "owner/repo"
-        mock_result2.sha = "def456"
-        mock_result2.score = 0.9
-        
-        mock_github.return_value.search_code.return_value = [mock_result1, mock_result2]
-        
-        mock_repo = Mock(spec=Repository)
-        mock_repo.full_name = "owner/repo"
+    async def test_search_payment_files(self, connector, mock_github, mock_repo):
+        repository = SimpleNamespace(full_name="owner/repo")
+        mock_github.return_value.search_code.return_value = [
+            SimpleNamespace(path="src/stripe_payment.py", repository=repository, sha="abc123", score=1.0),
+            SimpleNamespace(path="lib/square_checkout.js", repository=repository, sha="def456", score=0.9)
+        ]
         
         payment_files = await connector.search_payment_files(mock_repo)
         
@@ -147,12 +177,57 @@ class TestGitHubMCPConnector:
         assert payment_files[1]["path"] == "lib/square_checkout.js"
     
     @pytest.mark.unit
-    async def test_create_branch(self, connector):
-        mock_repo = Mock(spec=Repository)
-        mock_ref = Mock()
-        mock_ref.object.sha = "main123"
-        mock_repo.get_git_ref.return_value = mock_ref
-        mock_repo.create_git_ref.return_value = Mock()
+    async def test_iter_payment_files_stops_at_limit(self, connector, mock_github, mock_repo):
+        consumed = []
+        
+        def results():
+            for i in range(100):
+                consumed.append(i)
+                yield SimpleNamespace(path=f"payment_{i}.py", repository=SimpleNamespace(full_name="owner/repo"), sha=str(i), score=1.0)
+        
+        mock_github.return_value.search_code.return_value = results()
+        
+        paths = [file_info["path"] async for file_info in connector.iter_payment_files(mock_repo, limit=2)]
+        
+        assert paths == ["payment_0.py", "payment_1.py"]
+        assert len(consumed) == 2
+    
+    @pytest.mark.unit
+    async def test_get_repository_is_cached_across_concurrent_calls(self, connector, mock_github):
+        mock_github.return_value.get_repo.return_value = Mock()
+        
+        first, second = await asyncio.gather(
+            connector.get_repository("owner/repo"),
+            connector.get_repository("owner/repo")
+        )
+        
+        assert first is second
+        mock_github.return_value.get_repo.assert_called_once_with("owner/repo")
+    
+    @pytest.mark.unit
+    async def test_failed_fetch_is_not_cached(self, connector, mock_github):
+        mock_github.return_value.get_repo.side_effect = [Exception("rate limited"), Mock()]
+        
+        with pytest.raises(Exception, match="rate limited"):
+            await connector.get_repository("owner/repo")
+        await connector.get_repository("owner/repo")
+        
+        assert mock_github.return_value.get_repo.call_count == 2
+    
+    @pytest.mark.unit
+    async def test_search_payment_files_cache_expires(self, connector, mock_github, mock_repo):
+        mock_github.return_value.search_code.return_value = []
+        
+        await connector.search_payment_files(mock_repo)
+        await connector.search_payment_files(mock_repo)
+        connector._cache_expiry[("search", "owner/repo")] = 0
+        await connector.search_payment_files(mock_repo)
+        
+        assert mock_github.return_value.search_code.call_count == 2
+    
+    @pytest.mark.unit
+    async def test_create_branch(self, connector, mock_repo):
+        mock_repo.get_git_ref.return_value = SimpleNamespace(object=SimpleNamespace(sha="main123"))
         
         branch_name = await connector.create_branch(mock_repo, "flowglad-migration")
         
@@ -164,17 +239,12 @@ class TestGitHubMCPConnector:
         )
     
     @pytest.mark.unit
-    async def test_update_existing_file(self, connector):
-        mock_repo = Mock(spec=Repository)
-        mock_file = Mock()
-        mock_file.sha = "old_sha"
-        mock_repo.get_contents.return_value = mock_file
-        
-        mock_result = {
-            "commit": Mock(sha="new_sha"),
-            "content": Mock(path="payment.py")
+    async def test_update_existing_file(self, connector, mock_repo):
+        mock_repo.get_contents.return_value = SimpleNamespace(sha="old_sha")
+        mock_repo.update_file.return_value = {
+            "commit": SimpleNamespace(sha="new_sha"),
+            "content": SimpleNamespace(path="payment.py")
         }
-        mock_repo.update_file.return_value = mock_result
         
         result = await connector.update_file(
             mock_repo, 
@@ -188,15 +258,13 @@ class TestGitHubMCPConnector:
         assert result["file"] == "payment.py"
     
     @pytest.mark.unit
-    async def test_create_new_file(self, connector):
-        mock_repo = Mock(spec=Repository)
-        mock_repo.get_contents.side_effect = Exception("File not found")
+    async def test_create_new_file(self, connector, mock_repo):
+        mock_repo.get_contents.side_effect = GithubException(404, message="Not Found")
         
-        mock_result = {
-            "commit": Mock(sha="new_sha"),
-            "content": Mock(path="new_file.py")
+        mock_repo.create_file.return_value = {
+            "commit": SimpleNamespace(sha="new_sha"),
+            "content": SimpleNamespace(path="new_file.py")
         }
-        mock_repo.create_file.return_value = mock_result
         
         result = await connector.update_file(
             mock_repo,
@@ -206,17 +274,26 @@ class TestGitHubMCPConnector:
             "feature-branch"
         )
         
-        assert result["commit"] == "new_sha"
-        assert result["file"] == "new_file.py"
+        assert result == {"commit": "new_sha", "file": "new_file.py"}
+        mock_repo.update_file.assert_not_called()
     
     @pytest.mark.unit
-    async def test_create_pull_request(self, connector):
-        mock_repo = Mock(spec=Repository)
-        mock_pr = Mock()
-        mock_pr.number = 42
-        mock_pr.html_url = "https://github.com/owner/repo/pull/42"
-        mock_pr.state = "open"
-        mock_repo.create_pull.return_value = mock_pr
+    async def test_update_file_surfaces_non_404_errors(self, connector):
+        mock_repo = Mock()
+        mock_repo.get_contents.side_effect = GithubException(403, message="rate limit exceeded")
+        
+        with pytest.raises(GithubException):
+            await connector.update_file(mock_repo, "payment.py", "new content", "Update", "feature-branch")
+        
+        mock_repo.create_file.assert_not_called()
+    
+    @pytest.mark.unit
+    async def test_create_pull_request(self, connector, mock_repo):
+        mock_repo.create_pull.return_value = SimpleNamespace(
+            number=42,
+            html_url="https://github.com/owner/repo/pull/42",
+            state="open"
+        )
         
         result = await connector.create_pull_request(
             mock_repo,
@@ -230,8 +307,19 @@ class TestGitHubMCPConnector:
         assert result["state"] == "open"
     
     @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_close(self, connector):
+    async def test_close(self, mock_config, mock_github):
+        connector = GitHubMCPConnector(mock_config)
         with patch.object(connector.client, 'aclose', new_callable=AsyncMock) as mock_close:
             await connector.close()
-            mock_close.assert_called_once()
\ No newline at end of file
+            mock_close.assert_called_once()
+    
+    @pytest.mark.unit
+    async def test_close_leaves_shared_client_open(self, mock_config, mock_github):
+        shared_client = Mock()
+        shared_client.aclose = AsyncMock()
+        
+        connector = GitHubMCPConnector(mock_config, client=shared_client)
+        await connector.close()
+        
+        assert connector.client is shared_client
+        shared_client.aclose.assert_not_called()
@@ -1,37 +1,90 @@
 import pytest
-from unittest.mock import Mock, patch, AsyncMock, mock_open
-import sys
-import os
-sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+import asyncio
+import io
+import threading
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+import httpx
 
 from morph_editor import MorphLLMEditor, EditRequest, EditResult
 
 
+_PR_CHANGES = [
+    EditResult(success=True, file_path="file1.py", changes_made=["Added flowglad"]),
+    EditResult(success=True, file_path="file2.py", changes_made=["Removed stripe"]),
+    EditResult(success=False, file_path="file3.py", changes_made=[], error="Failed")
+]
+_MANY_PR_CHANGES = [EditResult(success=True, file_path=f"file{i}.py", changes_made=[]) for i in range(15)]
+
+
+class _FakeFile(io.StringIO):
+    def __exit__(self, *exc_info):
+        return False
+
+
 @pytest.fixture
+def fake_open(monkeypatch):
+    def install(read_data):
+        written = []
+        
+        def open_file(path, mode='r', *args, **kwargs):
+            if 'w' in mode:
+                written.append(_FakeFile())
+                return written[-1]
+            return _FakeFile(read_data)
+        
+        monkeypatch.setattr('builtins.open', open_file)
+        return written
+    return install
+
+
+@pytest.fixture(scope="module")
 def mock_genai():
     with patch('morph_editor.genai') as mock:
         yield mock
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def editor(mock_genai):
-    with patch.dict(os.environ, {'GEMINI_API_KEY': 'test_key', 'GEMINI_MODEL': 'gemini-2.5-flash-lite'}):
-        return MorphLLMEditor()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('GEMINI_API_KEY', 'test_key')
+        mp.setenv('GEMINI_MODEL', 'gemini-2.5-flash-lite')
+        return MorphLLMEditor(client=httpx.AsyncClient(timeout=0.1))
+
+
+@pytest.fixture(scope="module")
+def canned_response():
+    return SimpleNamespace(text="")
+
+
+@pytest.fixture(autouse=True)
+def reset_editor(editor, mock_genai, canned_response):
+    mock_genai.reset_mock()
+    canned_response.text = ""
+    editor.model.generate_content = lambda *args, **kwargs: canned_response
 
 
 class TestMorphLLMEditor:
     
-    @pytest.mark.unit
-    def test_initialization(self, mock_genai):
-        with patch.dict(os.environ, {'GEMINI_API_KEY': 'test_key', 'GEMINI_MODEL': 'gemini-2.5-flash-lite'}):
-            editor = MorphLLMEditor()
-            
-            mock_genai.configure.assert_called_once_with(api_key='test_key')
-            mock_genai.GenerativeModel.assert_called_once_with('gemini-2.5-flash-lite')
-    
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_apply_edits_success(self, editor):
+    pytestmark = pytest.mark.unit
+    
+    def test_initialization(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr('morph_editor.genai', SimpleNamespace(
+            configure=lambda **kwargs: calls.append(("configure", kwargs)),
+            GenerativeModel=lambda model_name: calls.append(("GenerativeModel", model_name))
+        ))
+        monkeypatch.setenv('GEMINI_API_KEY', 'test_key')
+        monkeypatch.setenv('GEMINI_MODEL', 'gemini-2.5-flash-lite')
+        
+        MorphLLMEditor()
+        
+        assert calls == [
+            ("configure", {"api_key": "test_key"}),
+            ("GenerativeModel", "gemini-2.5-flash-lite")
+        ]
+    
+    async def test_apply_edits_success(self, editor, monkeypatch, canned_response, fake_open):
         edit_request = EditRequest(
             file_path="payment.py",
             original_code="stripe.Customer.create()",
@@ -39,21 +92,18 @@ class TestMorphLLMEditor:
             description="Convert to FlowGlad"
         )
         
-        with patch('morph_editor.os.path.exists', return_value=True):
-            with patch('builtins.open', mock_open(read_data="stripe.Customer.create()")):
-                mock_response = Mock()
-                mock_response.text = "flowglad.customers.create()"
-                editor.model.generate_content = Mock(return_value=mock_response)
-                
-                results = await editor.apply_edits("/repo", [edit_request])
-                
-                assert len(results) == 1
-                assert results[0].success is True
-                assert results[0].file_path == "payment.py"
-    
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_apply_edits_file_not_found(self, editor):
+        monkeypatch.setattr('morph_editor.os.path.exists', lambda path: True)
+        fake_open("stripe.Customer.create()")
+        
+        canned_response.text = "flowglad.customers.create()"
+        
+        results = await editor.apply_edits("/repo", [edit_request])
+        
+        assert len(results) == 1
+        assert results[0].success is True
+        assert results[0].file_path == "payment.py"
+    
+    async def test_apply_edits_file_not_found(self, editor, monkeypatch):
         edit_request = EditRequest(
             file_path="nonexistent.py",
             original_code="code",
@@ -61,16 +111,71 @@ class TestMorphLLMEditor:
             description="Test"
         )
         
-        with patch('morph_editor.os.path.exists', return_value=False):
-            results = await editor.apply_edits("/repo", [edit_request])
-            
-            assert len(results) == 1
-            assert results[0].success is False
-            assert "File not found" in results[0].error
+        monkeypatch.setattr('morph_editor.os.path.exists', lambda path: False)
+        
+        results = await editor.apply_edits("/repo", [edit_request])
+        
+        assert len(results) == 1
+        assert results[0].success is False
+        assert "File not found" in results[0].error
+    
+    async def test_apply_edits_to_same_file_are_sequential(self, editor, monkeypatch):
+        files = {"/repo/config.py": "a = 1\nb = 2"}
+        edits = [
+            EditRequest(file_path="config.py", original_code="a = 1", target_code="a = 10", description="Bump a"),
+            EditRequest(file_path="config.py", original_code="b = 2", target_code="b = 20", description="Bump b")
+        ]
+        
+        monkeypatch.setattr('morph_editor.os.path.exists', lambda path: path in files)
+        monkeypatch.setattr('morph_editor._read_text', lambda path: files[path])
+        monkeypatch.setattr('morph_editor._write_text', files.__setitem__)
+        
+        results = await editor.apply_edits("/repo", edits)
+        
+        assert [r.success for r in results] == [True, True]
+        assert files["/repo/config.py"] == "a = 10\nb = 20"
+    
+    async def test_apply_edits_runs_llm_fallbacks_concurrently(self, editor, monkeypatch):
+        files = {"/repo/a.py": "import stripe", "/repo/b.py": "import stripe"}
+        edits = [
+            EditRequest(file_path=path, original_code="stripe.Charge.create()", target_code="flowglad.checkout.create()", description="Convert")
+            for path in ("a.py", "b.py")
+        ]
+        both_in_flight = threading.Barrier(2, timeout=1)
+        
+        def generate_content(prompt):
+            both_in_flight.wait()
+            return SimpleNamespace(text="import flowglad")
+        
+        editor.model.generate_content = generate_content
+        monkeypatch.setattr('morph_editor.os.path.exists', lambda path: path in files)
+        monkeypatch.setattr('morph_editor._read_text', lambda path: files[path])
+        monkeypatch.setattr('morph_editor._write_text', files.__setitem__)
+        
+        results = await editor.apply_edits("/repo", edits, max_concurrency=2)
+        
+        assert [r.success for r in results] == [True, True]
+    
+    async def test_apply_single_edit(self, editor, monkeypatch, canned_response, fake_open):
+        edit_request = EditRequest(
+            file_path="test.py",
+            original_code="old_code",
+            target_code="new_code",
+            description="Test edit"
+        )
+        
+        monkeypatch.setattr('morph_editor.os.path.join', lambda *parts: "/repo/test.py")
+        monkeypatch.setattr('morph_editor.os.path.exists', lambda path: True)
+        fake_open("old_code")
+        
+        canned_response.text = "new_code"
+        
+        result = await editor._apply_single_edit("/repo", edit_request)
+        
+        assert result.success is True
+        assert result.file_path == "test.py"
     
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_apply_single_edit(self, editor):
+    async def test_apply_single_edit_skips_write_when_unchanged(self, editor, monkeypatch, canned_response, fake_open):
         edit_request = EditRequest(
             file_path="test.py",
             original_code="old_code",
@@ -78,53 +183,75 @@ class TestMorphLLMEditor:
             description="Test edit"
         )
         
-        with patch('morph_editor.os.path.join', return_value="/repo/test.py"):
-            with patch('morph_editor.os.path.exists', return_value=True):
-                with patch('builtins.open', mock_open(read_data="old_code")):
-                    mock_response = Mock()
-                    mock_response.text = "new_code"
-                    editor.model.generate_content = Mock(return_value=mock_response)
-                    
-                    result = await editor._apply_single_edit("/repo", edit_request)
-                    
-                    assert result.success is True
-                    assert result.file_path == "test.py"
-    
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_generate_edit_with_code_block(self, editor):
+        monkeypatch.setattr('morph_editor.os.path.exists', lambda path: True)
+        written = fake_open("unrelated")
+        
+        canned_response.text = "unrelated"
+        
+        result = await editor._apply_single_edit("/repo", edit_request)
+        
+        assert result.success is True
+        assert result.changes_made == []
+        assert written == []
+    
+    async def test_apply_single_edit_replaces_unique_match_without_llm(self, editor, monkeypatch, fake_open):
+        edit_request = EditRequest(
+            file_path="test.py",
+            original_code="stripe.Customer.create()",
+            target_code="flowglad.customers.create()",
+            description="Test edit"
+        )
+        
+        monkeypatch.setattr('morph_editor.os.path.exists', lambda path: True)
+        written = fake_open("import os\nstripe.Customer.create()\n")
+        
+        editor.model.generate_content = Mock()
+        
+        result = await editor._apply_single_edit("/repo", edit_request)
+        
+        assert result.success is True
+        editor.model.generate_content.assert_not_called()
+        assert [f.getvalue() for f in written] == ["import os\nflowglad.customers.create()\n"]
+    
+    def test_replace_unique_rejects_ambiguous_matches(self, editor):
+        assert editor._replace_unique("a = x\nb = x", "x", "y") is None
+        assert editor._replace_unique("aaa", "aa", "b") is None
+        assert editor._replace_unique("a = x", "missing", "y") is None
+        assert editor._replace_unique("a = x", "x", "y") == "a = y"
+    
+    async def test_generate_edit_with_code_block(self, editor, canned_response):
         full_content = "import stripe\nstripe.Customer.create()"
         old_code = "stripe.Customer.create()"
         new_code = "flowglad.customers.create()"
         
-        mock_response = Mock()
-        mock_response.text = """
+        canned_response.text = """
 ```python
 import flowglad
 flowglad.customers.create()
 ```
 """
-        editor.model.generate_content = Mock(return_value=mock_response)
         
         result = await editor._generate_edit(full_content, old_code, new_code, "Convert to FlowGlad")
         
         assert "import flowglad" in result
         assert "flowglad.customers.create()" in result
     
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_generate_edit_without_code_block(self, editor):
+    async def test_generate_edit_without_code_block(self, editor, canned_response):
         full_content = "old content"
         
-        mock_response = Mock()
-        mock_response.text = "new content"
-        editor.model.generate_content = Mock(return_value=mock_response)
+        canned_response.text = "new content"
         
         result = await editor._generate_edit(full_content, "old", "new", "Test")
         
         assert result == "new content"
     
-    @pytest.mark.unit
+    async def test_generate_edit_fence_must_start_line(self, editor, canned_response):
+        canned_response.text = "Here: ```inline``` code\n```js\nconst a = 1;\n\n```\ntrailing"
+        
+        result = await editor._generate_edit("", "old", "new", "Test")
+        
+        assert result == "const a = 1;\n"
+    
     def test_extract_changes(self, editor):
         original = "line1\nline2\nline3"
         modified = "line1\nline2_modified\nline3\nline4"
@@ -135,9 +262,7 @@ flowglad.customers.create()
         assert any("Added: line2_modified" in change for change in changes)
         assert any("Added: line4" in change for change in changes)
     
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_batch_convert_files(self, editor):
+    async def test_batch_convert_files(self, editor, monkeypatch):
         transformations = [
             {
                 "file_path": "file1.py",
@@ -153,58 +278,120 @@ flowglad.customers.create()
             }
         ]
         
-        with patch.object(editor, '_apply_single_edit', new_callable=AsyncMock) as mock_apply:
-            mock_apply.side_effect = [
-                EditResult(success=True, file_path="file1.py", changes_made=[]),
-                EditResult(success=False, file_path="file2.py", changes_made=[], error="Error")
-            ]
-            
-            result = await editor.batch_convert_files("/repo", transformations)
-            
-            assert result["total_files"] == 2
-            assert result["successful"] == 1
-            assert result["failed"] == 1
-            assert len(result["results"]) == 2
-    
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_validate_changes_python_valid(self, editor):
-        with patch('morph_editor.os.path.join', return_value="/repo/test.py"):
-            with patch('builtins.open', mock_open(read_data="import flowglad\nprint('hello')")):
-                validations = await editor.validate_changes("/repo", "test.py")
-                
-                assert validations["syntax_valid"] is True
-                assert validations["imports_resolved"] is True
-    
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_validate_changes_python_invalid_syntax(self, editor):
-        with patch('morph_editor.os.path.join', return_value="/repo/test.py"):
-            with patch('builtins.open', mock_open(read_data="import flowglad\nprint('hello")):
-                validations = await editor.validate_changes("/repo", "test.py")
-                
-                assert validations["syntax_valid"] is False
-    
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_validate_changes_error(self, editor):
-        with patch('morph_editor.os.path.join', return_value="/repo/test.py"):
-            with patch('builtins.open', side_effect=FileNotFoundError("Not found")):
-                validations = await editor.validate_changes("/repo", "test.py")
-                
-                assert "error" in validations
-                assert validations["syntax_valid"] is False
-    
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_create_pull_request_description(self, editor):
-        changes = [
-            EditResult(success=True, file_path="file1.py", changes_made=["Added flowglad"]),
-            EditResult(success=True, file_path="file2.py", changes_made=["Removed stripe"]),
-            EditResult(success=False, file_path="file3.py", changes_made=[], error="Failed")
+        results = iter([
+            EditResult(success=True, file_path="file1.py", changes_made=[]),
+            EditResult(success=False, file_path="file2.py", changes_made=[], error="Error")
+        ])
+        
+        async def apply_edit(repo_path, edit):
+            return next(results)
+        
+        monkeypatch.setattr(editor, '_apply_single_edit', apply_edit)
+        
+        result = await editor.batch_convert_files("/repo", transformations)
+        
+        assert result["total_files"] == 2
+        assert result["successful"] == 1
+        assert result["failed"] == 1
+        assert len(result["results"]) == 2
+    
+    async def test_batch_convert_files_bounds_concurrency(self, editor, monkeypatch):
+        transformations = [
+            {
+                "file_path": f"file{i}.py",
+                "original_code": "old",
+                "transformed_code": "new"
+            }
+            for i in range(6)
         ]
+        in_flight = 0
+        peak = 0
+        
+        async def apply_edit(repo_path, edit):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+            if edit.file_path == "file3.py":
+                raise RuntimeError("boom")
+            return EditResult(success=True, file_path=edit.file_path, changes_made=[])
         
-        description = await editor.create_pull_request_description(changes)
+        monkeypatch.setattr(editor, '_apply_single_edit', apply_edit)
+        result = await editor.batch_convert_files("/repo", transformations, max_concurrency=2)
+        
+        assert peak == 2
+        assert result["successful"] == 5
+        assert result["failed"] == 1
+        assert [r.file_path for r in result["results"]] == [t["file_path"] for t in transformations]
+        assert result["results"][3].error == "boom"
+    
+    async def test_batch_convert_files_serialises_same_file(self, editor, monkeypatch):
+        files = {"/repo/config.py": "a = 1\nb = 2"}
+        transformations = [
+            {"file_path": "config.py", "original_code": "a = 1", "transformed_code": "a = 10"},
+            {"file_path": "config.py", "original_code": "b = 2", "transformed_code": "b = 20"}
+        ]
+        
+        monkeypatch.setattr('morph_editor.os.path.exists', lambda path: path in files)
+        monkeypatch.setattr('morph_editor._read_text', lambda path: files[path])
+        monkeypatch.setattr('morph_editor._write_text', files.__setitem__)
+        
+        result = await editor.batch_convert_files("/repo", transformations)
+        
+        assert result["successful"] == 2
+        assert files["/repo/config.py"] == "a = 10\nb = 20"
+    
+    async def test_batch_convert_files_overlaps_llm_fallbacks(self, editor, monkeypatch):
+        files = {"/repo/a.py": "import stripe", "/repo/b.py": "import stripe"}
+        transformations = [
+            {"file_path": path, "original_code": "stripe.Charge.create()", "transformed_code": "flowglad.checkout.create()"}
+            for path in ("a.py", "b.py")
+        ]
+        both_in_flight = threading.Barrier(2, timeout=1)
+        
+        def generate_content(prompt):
+            both_in_flight.wait()
+            return SimpleNamespace(text="import flowglad")
+        
+        editor.model.generate_content = generate_content
+        monkeypatch.setattr('morph_editor.os.path.exists', lambda path: path in files)
+        monkeypatch.setattr('morph_editor._read_text', lambda path: files[path])
+        monkeypatch.setattr('morph_editor._write_text', files.__setitem__)
+        
+        result = await editor.batch_convert_files("/repo", transformations)
+        
+        assert result["successful"] == 2
+        assert files == {"/repo/a.py": "import flowglad", "/repo/b.py": "import flowglad"}
+    
+    async def test_validate_changes_python_valid(self, editor, monkeypatch, fake_open):
+        monkeypatch.setattr('morph_editor.os.path.join', lambda *parts: "/repo/test.py")
+        fake_open("import flowglad\nprint('hello')")
+        
+        validations = await editor.validate_changes("/repo", "test.py")
+        
+        assert validations["syntax_valid"] is True
+        assert validations["imports_resolved"] is True
+    
+    async def test_validate_changes_python_invalid_syntax(self, editor, monkeypatch, fake_open):
+        monkeypatch.setattr('morph_editor.os.path.join', lambda *parts: "/repo/test.py")
+        fake_open("import flowglad\nprint('hello")
+        
+        validations = await editor.validate_changes("/repo", "test.py")
+        
+        assert validations["syntax_valid"] is False
+    
+    async def test_validate_changes_error(self, editor, monkeypatch):
+        monkeypatch.setattr('morph_editor.os.path.join', lambda *parts: "/repo/test.py")
+        monkeypatch.setattr('builtins.open', Mock(side_effect=FileNotFoundError("Not found")))
+        
+        validations = await editor.validate_changes("/repo", "test.py")
+        
+        assert "error" in validations
+        assert validations["syntax_valid"] is False
+    
+    async def test_create_pull_request_description(self, editor):
+        description = await editor.create_pull_request_description(_PR_CHANGES)
         
         assert "## FlowGlad Migration" in description
         assert "file1.py" in description
@@ -213,20 +400,13 @@ flowglad.customers.create()
         assert "### Failed Conversions" in description
         assert "### Testing Required" in description
     
-    @pytest.mark.unit
-    @pytest.mark.asyncio
     async def test_create_pull_request_description_many_files(self, editor):
-        changes = [
-            EditResult(success=True, file_path=f"file{i}.py", changes_made=[])
-            for i in range(15)
-        ]
-        
-        description = await editor.create_pull_request_description(changes)
+        description = await editor.create_pull_request_description(_MANY_PR_CHANGES)
         
         assert "15 files successfully converted" in description
         assert "... and 5 more" in description
     
-    @pytest.mark.unit
-    @pytest.mark.asyncio
-    async def test_client_timeout_configuration(self, editor):
+    def test_client_timeout_configuration(self, mock_genai):
+        editor = MorphLLMEditor()
+        
         assert editor.client.timeout == 60
\ No newline at end of file
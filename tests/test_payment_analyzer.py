@@ -1,27 +1,18 @@
+import ast
+import re
 import pytest
 from unittest.mock import Mock, patch
-import sys
-import os
-sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 from payment_analyzer import (
     PaymentLogicAnalyzer, 
     PaymentFlow, 
     PaymentProvider, 
-    PaymentPattern
+    PaymentPattern,
+    _PatternSet
 )
 
 
-@pytest.fixture
-def analyzer():
-    return PaymentLogicAnalyzer()
-
-
-class TestPaymentLogicAnalyzer:
-    
-    @pytest.mark.unit
-    def test_analyze_stripe_python_file(self, analyzer):
-        python_code = """
+_STRIPE_PYTHON_CODE = """
 import stripe
 
 stripe.api_key = 'sk_test_123'
@@ -39,17 +30,8 @@ def create_payment():
     
     return payment_intent
 """
-        
-        flows = analyzer.analyze_file("payment.py", python_code)
-        
-        assert len(flows) > 0
-        assert any(f.provider == PaymentProvider.STRIPE for f in flows)
-        assert any(f.flow_type == "customer_creation" for f in flows)
-        assert any(f.flow_type == "payment_intent" for f in flows)
-    
-    @pytest.mark.unit
-    def test_analyze_square_python_file(self, analyzer):
-        python_code = """
+
+_SQUARE_PYTHON_CODE = """
 from square.client import Client
 
 client = Client(
@@ -69,16 +51,8 @@ def process_payment():
     )
     return result
 """
-        
-        flows = analyzer.analyze_file("square_payment.py", python_code)
-        
-        assert len(flows) > 0
-        assert any(f.provider == PaymentProvider.SQUARE for f in flows)
-        assert any("create_payment" in method for f in flows for method in f.methods)
-    
-    @pytest.mark.unit
-    def test_analyze_javascript_file(self, analyzer):
-        js_code = """
+
+_CHECKOUT_JS_CODE = """
 const stripe = require('stripe')('sk_test_123');
 
 async function createCheckoutSession() {
@@ -96,16 +70,8 @@ async function createCheckoutSession() {
     return session;
 }
 """
-        
-        flows = analyzer.analyze_file("checkout.js", js_code)
-        
-        assert len(flows) > 0
-        assert any(f.provider == PaymentProvider.STRIPE for f in flows)
-        assert any("checkout" in f.flow_type.lower() for f in flows)
-    
-    @pytest.mark.unit
-    def test_analyze_typescript_file(self, analyzer):
-        ts_code = """
+
+_SUBSCRIPTION_TS_CODE = """
 import Stripe from 'stripe';
 
 const stripe = new Stripe('sk_test_123', {
@@ -121,16 +87,8 @@ export async function createSubscription(customerId: string) {
     return subscription;
 }
 """
-        
-        flows = analyzer.analyze_file("subscription.ts", ts_code)
-        
-        assert len(flows) > 0
-        assert any(f.provider == PaymentProvider.STRIPE for f in flows)
-        assert any("subscription" in f.flow_type.lower() for f in flows)
-    
-    @pytest.mark.unit
-    def test_analyze_java_file(self, analyzer):
-        java_code = """
+
+_PAYMENT_SERVICE_JAVA_CODE = """
 import com.stripe.Stripe;
 import com.stripe.model.Customer;
 import com.stripe.model.PaymentIntent;
@@ -150,15 +108,105 @@ public class PaymentService {
     }
 }
 """
+
+_PAYMENT_SUBSCRIPTION_CODE = """
+import stripe
+
+def process_payment_and_subscription(customer_email):
+    customer = stripe.Customer.create(email=customer_email)
+    
+    subscription = stripe.Subscription.create(
+        customer=customer.id,
+        items=[{'price': 'price_monthly'}]
+    )
+    
+    return subscription
+"""
+
+_WEBHOOK_CODE = """
+import stripe
+
+def handle_webhook(payload, sig_header):
+    event = stripe.Webhook.construct_event(
+        payload, sig_header, webhook_secret
+    )
+    
+    if event.type == 'payment_intent.succeeded':
+        payment_intent = event.data.object
+        process_successful_payment(payment_intent)
+    
+    return event
+"""
+
+_REFUND_CODE = """
+import stripe
+
+def create_refund(payment_intent_id):
+    refund = stripe.Refund.create(
+        payment_intent=payment_intent_id,
+        reason='requested_by_customer'
+    )
+    return refund
+"""
+
+_BROKEN_PYTHON_CODE = """
+import stripe
+
+def broken_function(
+    # Missing closing parenthesis
+    stripe.Customer.create(email='test@example.com')
+"""
+
+_NESTED_PAYMENT_CODE = """
+import stripe
+
+def process_payment():
+    def charge_card():
+        return stripe.Refund.create(charge='ch_1')
+    return charge_card()
+"""
+
+_NON_PAYMENT_CODE = """
+def calculate_fibonacci(n):
+    if n <= 1:
+        return n
+    return calculate_fibonacci(n-1) + calculate_fibonacci(n-2)
+"""
+
+
+@pytest.fixture(scope="session")
+def analyzer():
+    return PaymentLogicAnalyzer()
+
+
+@pytest.fixture(autouse=True)
+def reset_analyzer(analyzer):
+    yield
+    analyzer.clear_cache()
+
+
+class TestPaymentLogicAnalyzer:
+    
+    pytestmark = pytest.mark.unit
+    
+    @pytest.mark.parametrize("file_path,code,provider,flow_types,method", [
+        pytest.param("payment.py", _STRIPE_PYTHON_CODE, PaymentProvider.STRIPE, ("customer_creation", "payment_intent"), "stripe.PaymentIntent.create", id="stripe_python"),
+        pytest.param("square_payment.py", _SQUARE_PYTHON_CODE, PaymentProvider.SQUARE, (), "create_payment", id="square_python"),
+        pytest.param("checkout.js", _CHECKOUT_JS_CODE, PaymentProvider.STRIPE, ("checkout",), "stripe.checkout.sessions.create", id="javascript"),
+        pytest.param("subscription.ts", _SUBSCRIPTION_TS_CODE, PaymentProvider.STRIPE, ("subscription",), "stripe.subscriptions.create", id="typescript"),
+        pytest.param("PaymentService.java", _PAYMENT_SERVICE_JAVA_CODE, PaymentProvider.STRIPE, ("initialization", "payment_intent"), "PaymentIntent.create", id="java"),
+        pytest.param("payment_sub.py", _PAYMENT_SUBSCRIPTION_CODE, PaymentProvider.STRIPE, ("subscription",), "stripe.Subscription.create", id="function_with_payment_keywords"),
+        pytest.param("webhook.py", _WEBHOOK_CODE, PaymentProvider.STRIPE, ("webhook",), "stripe.Webhook.construct_event", id="webhook"),
+        pytest.param("refund.py", _REFUND_CODE, PaymentProvider.STRIPE, ("refund",), "stripe.Refund.create", id="refund")
+    ])
+    def test_analyze_file(self, analyzer, file_path, code, provider, flow_types, method):
+        flows = analyzer.analyze_file(file_path, code)
         
-        flows = analyzer.analyze_file("PaymentService.java", java_code)
-        
-        assert len(flows) > 0
-        assert any(f.provider == PaymentProvider.STRIPE for f in flows)
-        assert any("initialization" in f.flow_type for f in flows)
-        assert any("payment_intent" in f.flow_type for f in flows)
+        assert any(f.provider == provider for f in flows)
+        missing = set(flow_types).difference(f.flow_type for f in flows)
+        assert not missing, missing
+        assert any(method in m for f in flows for m in f.methods)
     
-    @pytest.mark.unit
     def test_extract_payment_architecture(self, analyzer):
         flows = [
             PaymentFlow(
@@ -198,97 +246,139 @@ public class PaymentService {
         assert architecture["flow_summary"]["payment_intent"] == 1
         assert architecture["flow_summary"]["payment_creation"] == 1
     
-    @pytest.mark.unit
-    def test_fallback_analysis_on_syntax_error(self, analyzer):
-        invalid_python = """
-import stripe
-
-def broken_function(
-    # Missing closing parenthesis
-    stripe.Customer.create(email='test@example.com')
-"""
+    def test_provider_values_are_plain_strings(self, analyzer):
+        flows = analyzer.analyze_file("payment.py", "import stripe\n")
         
-        flows = analyzer.analyze_file("broken.py", invalid_python)
+        assert flows[0].provider == "stripe"
+        assert flows[0].provider.value == "stripe"
+        assert [type(name) for name in analyzer.extract_payment_architecture(flows)["providers"]] == [str]
+    
+    def test_fallback_analysis_on_syntax_error(self, analyzer):
+        flows = analyzer.analyze_file("broken.py", _BROKEN_PYTHON_CODE)
         
         # Should still detect stripe patterns even with syntax error
         assert len(flows) > 0
         assert any(f.provider == PaymentProvider.STRIPE for f in flows)
     
-    @pytest.mark.unit
-    def test_analyze_function_with_payment_keywords(self, analyzer):
-        python_code = """
-import stripe
-
-def process_payment_and_subscription(customer_email):
-    customer = stripe.Customer.create(email=customer_email)
+    def test_fallback_analysis_reports_matching_lines(self, analyzer):
+        invalid_python = "def broken(:\n    pass\n  price = stripe.Price.create(stripe.Customer.create())  \n"
+        
+        flows = analyzer.analyze_file("broken.py", invalid_python)
+        
+        assert [(f.flow_type, f.line_start) for f in flows] == [("customer_creation", 3), ("pricing", 3)]
+        assert flows[0].methods == ["price = stripe.Price.create(stripe.Customer.create())"]
     
-    subscription = stripe.Subscription.create(
-        customer=customer.id,
-        items=[{'price': 'price_monthly'}]
-    )
+    def test_nested_payment_functions_share_calls(self, analyzer):
+        with patch.object(analyzer._pattern_set, 'matching', wraps=analyzer._pattern_set.matching) as mock_matching:
+            flows = analyzer.analyze_file("nested.py", _NESTED_PAYMENT_CODE)
+        
+        function_flows = [f for f in flows if f.line_end != f.line_start]
+        assert [(f.line_start, f.flow_type, f.methods) for f in function_flows] == [
+            (4, "refund", ["stripe.Refund.create"]),
+            (5, "refund", ["stripe.Refund.create"])
+        ]
+        assert mock_matching.call_count == 2
     
-    return subscription
-"""
+    def test_identical_flows_on_one_line_are_deduplicated(self, analyzer):
+        python_code = "import stripe, stripe.error\nstripe.Price.create(stripe.Price.create(), stripe.Price.retrieve())\n"
         
-        flows = analyzer.analyze_file("payment_sub.py", python_code)
+        flows = analyzer.analyze_file("prices.py", python_code)
         
-        assert len(flows) > 0
-        subscription_flows = [f for f in flows if "subscription" in f.flow_type]
-        assert len(subscription_flows) > 0
+        assert [(f.flow_type, f.line_start, f.methods) for f in flows] == [
+            ("import", 1, []),
+            ("pricing", 2, ["stripe.Price.create"]),
+            ("pricing", 2, ["stripe.Price.retrieve"])
+        ]
     
-    @pytest.mark.unit
-    def test_webhook_detection(self, analyzer):
-        python_code = """
-import stripe
-
-def handle_webhook(payload, sig_header):
-    event = stripe.Webhook.construct_event(
-        payload, sig_header, webhook_secret
-    )
+    def test_pattern_set_matches_in_table_order(self, analyzer):
+        matches = analyzer._pattern_set.matching("stripe.Price.create(stripe.Customer.create())")
+        
+        assert [p.flow_type for p in matches] == ["customer_creation", "pricing"]
+        assert analyzer._pattern_set.matching("requests.post") == []
     
-    if event.type == 'payment_intent.succeeded':
-        payment_intent = event.data.object
-        process_successful_payment(payment_intent)
+    def test_javascript_scan_is_caseless_with_line_numbers(self, analyzer):
+        js_code = "const a = 1;\r\nawait STRIPE.Customers.create({});\r\n// café\r\nstripe.checkout.sessions.create({})"
+        
+        flows = analyzer.analyze_file("checkout.js", js_code)
+        
+        assert [(f.flow_type, f.line_start) for f in flows] == [("customer_creation", 2), ("checkout", 4)]
+        assert flows[0].methods == ["await STRIPE.Customers.create({});"]
+        assert analyzer.analyze_file("checkout.js", js_code.replace("café", "cafe")) == flows
     
-    return event
-"""
+    @pytest.mark.parametrize("pattern", [r"stripe\S+create", r"\bStripe\B", r"\\\D"])
+    def test_caseless_pattern_set_rejects_uppercase_escapes(self, pattern):
+        with pytest.raises(ValueError, match="lowercased safely"):
+            _PatternSet([(pattern, None)], re.IGNORECASE)
+    
+    def test_caseless_pattern_set_allows_escaped_backslash_before_capital(self):
+        pattern_set = _PatternSet([(r"C:\\Stripe", "path")], re.IGNORECASE)
+        
+        assert list(pattern_set.scan("x = 'c:\\stripe'")) == [(1, "x = 'c:\\stripe'", ["path"])]
+    
+    def test_python_parse_is_reused_for_identical_content(self, analyzer):
+        python_code = "import stripe\nstripe.Refund.create(charge='ch_cached_parse')\n"
         
-        flows = analyzer.analyze_file("webhook.py", python_code)
+        with patch('payment_analyzer.ast.parse', wraps=ast.parse) as mock_parse:
+            first = analyzer.analyze_file("refund.py", python_code)
+            second = analyzer.analyze_file("other/refund.py", python_code)
+            analyzer.clear_cache()
+            analyzer.analyze_file("refund.py", python_code)
         
-        assert any(f.flow_type == "webhook" for f in flows)
-        assert any(f.provider == PaymentProvider.STRIPE for f in flows)
+        assert mock_parse.call_count == 2
+        assert [f.flow_type for f in first] == [f.flow_type for f in second]
+        assert second[0].file_path == "other/refund.py"
     
-    @pytest.mark.unit
-    def test_refund_detection(self, analyzer):
-        python_code = """
-import stripe
-
-def create_refund(payment_intent_id):
-    refund = stripe.Refund.create(
-        payment_intent=payment_intent_id,
-        reason='requested_by_customer'
-    )
-    return refund
-"""
+    def test_repeated_content_is_analyzed_once(self, analyzer):
+        js_code = "await stripe.customers.create({});"
         
-        flows = analyzer.analyze_file("refund.py", python_code)
+        with patch.object(analyzer, '_analyze_javascript', wraps=analyzer._analyze_javascript) as mock_analyze:
+            first = analyzer.analyze_file("web/checkout.js", js_code)
+            first[0].methods.append("mutated")
+            second = analyzer.analyze_file("app/checkout.ts", js_code)
         
-        assert any(f.flow_type == "refund" for f in flows)
-        assert any(f.provider == PaymentProvider.STRIPE for f in flows)
+        mock_analyze.assert_called_once()
+        assert second[0].file_path == "app/checkout.ts"
+        assert second[0].methods == ["await stripe.customers.create({});"]
     
-    @pytest.mark.unit
     def test_empty_file(self, analyzer):
         flows = analyzer.analyze_file("empty.py", "")
         assert len(flows) == 0
     
-    @pytest.mark.unit
     def test_non_payment_file(self, analyzer):
-        python_code = """
-def calculate_fibonacci(n):
-    if n <= 1:
-        return n
-    return calculate_fibonacci(n-1) + calculate_fibonacci(n-2)
-"""
+        flows = analyzer.analyze_file("fibonacci.py", _NON_PAYMENT_CODE)
+        assert len(flows) == 0
+    
+    def test_files_without_provider_keywords_are_not_parsed(self, analyzer):
+        with patch('payment_analyzer.ast.parse') as mock_parse:
+            flows = analyzer.analyze_file("utils.py", "def add(a, b):\n    return a + b\n")
+        
+        assert flows == []
+        mock_parse.assert_not_called()
+        assert analyzer.analyze_file("Orders.java", "Customer.create(params);") == []
+        assert len(analyzer.analyze_file("Orders.java", "// Stripe\nCustomer.create(params);")) == 1
+        assert [f.flow_type for f in analyzer.analyze_file("billing.py", "import Stripe\n")] == ["import"]
+    
+    def test_analyze_files_matches_per_file_analysis(self, analyzer):
+        items = [
+            (f"payments/file_{i}.{ext}", code)
+            for i in range(12)
+            for ext, code in (
+                ("py", f"import stripe\nstripe.Refund.create(charge='ch_{i}')\n"),
+                ("js", "await stripe.customers.create({});"),
+                ("java", "import com.stripe.model.Customer;")
+            )
+        ]
+        expected = [flow for file_path, code in items for flow in analyzer.analyze_file(file_path, code)]
+        
+        assert analyzer.analyze_files(items, max_workers=2) == expected
+        assert analyzer.analyze_files(items[:3]) == expected[:4]
+    
+    def test_clear_cache_forces_reanalysis(self, analyzer):
+        js_code = "await stripe.refunds.create({});"
+        
+        with patch.object(analyzer, '_analyze_javascript', wraps=analyzer._analyze_javascript) as mock_analyze:
+            analyzer.analyze_file("refund.js", js_code)
+            analyzer.clear_cache()
+            analyzer.analyze_file("refund.js", js_code)
         
-        flows = analyzer.analyze_file("fibonacci.py", python_code)
-        assert len(flows) == 0
\ No newline at end of file
+        assert mock_analyze.call_count == 2
\ No newline at end of file